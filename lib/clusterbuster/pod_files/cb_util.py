@@ -18,6 +18,9 @@ import socket
 import re
 import os
 import fcntl
+import errno
+import random
+import select
 import struct
 from datetime import datetime
 import time
@@ -25,6 +28,14 @@ import sys
 import stat
 import math
 import subprocess
+import zlib
+import json
+import atexit
+import signal
+import threading
+import queue
+import weakref
+from collections import deque
 from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
 
 
@@ -73,8 +84,17 @@ class cb_util:
                         except Exception:
                             pass
         self.__offset = offset
-        self.__no_timestamp = no_timestamp
+        self.__log = log_buffer(timestamps=not no_timestamp)
         self.__initial_connect_time = None
+        self.__sessions = {}
+        self._resolver = resolver_cache()
+        self.__connect_policy = {
+            'initial_backoff': 0.1,
+            'max_backoff': 4,
+            'connect_timeout': 10,
+            'max_connecting': 0
+            }
+        self._reset_connect_statistics()
 
     def _set_offset(self, offset: float = 0):
         old_offset = self.__offset
@@ -99,18 +119,53 @@ class cb_util:
         :param string: String to be timestamped
         :return: Timestamped string
         """
-        if self.__no_timestamp:
-            return f'{string}\n'
-        else:
-            string = re.sub(r'\n(.*\S.*)', r'\n            \1', string)
-            return '%7d %s %s\n' % (os.getpid(), self._ts(), string)
+        return self.__log.format(time.time() - self.__offset, string)
+
+    def _timestamp(self, string, *args, level: int = None):
+        """
+        Timestamp a string and log it to stderr.  Output is buffered;
+        see log_buffer.
+        :param string: String to be logged with timestamp attached.
+                       If args are present, it is a format string for
+                       them, formatted only if and when it is written.
+        :param level: Log level of the message (default info)
+        """
+        self.__log.log(time.time() - self.__offset, log_buffer.INFO if level is None else level,
+                       string if isinstance(string, str) else str(string), args)
 
-    def _timestamp(self, string):
+    def _debug(self, string, *args):
         """
-        Timestamp a string and print it to stderr
-        :param string: String to be printed to stderr with timestamp attached
+        Log a debug message; see _timestamp
         """
-        print(self._get_timestamp(str(string)), file=sys.stderr, end='')
+        self._timestamp(string, *args, level=log_buffer.DEBUG)
+
+    def _set_log_policy(self, level=None, flush_interval: float = None, batch: int = None):
+        """
+        Set logging policy
+        :param level: Minimum level (name or number) of messages to be
+                      written; lower level messages are retained only
+                      to be dumped upon failure
+        :param flush_interval: Maximum time to hold messages before
+                               writing them
+        :param batch: Maximum number of messages to hold before writing
+                      them
+        """
+        if level is not None:
+            self.__log.level = log_buffer.parse_level(level)
+        if flush_interval is not None:
+            self.__log.flush_interval = flush_interval
+        if batch is not None:
+            self.__log.batch = max(1, batch)
+
+    def _flush_log(self, history: bool = False):
+        """
+        Write out any buffered log messages
+        :param history: Also write out retained messages below the log level
+        """
+        if history:
+            self.__log.dump_history()
+        else:
+            self.__log.flush()
 
     def _isdir(self, path: str):
         try:
@@ -144,6 +199,23 @@ class cb_util:
         r_children = getrusage(RUSAGE_CHILDREN)
         return r_self.ru_utime + r_children.ru_utime + r_self.ru_stime + r_children.ru_stime - old
 
+    @staticmethod
+    def _process_start_time():
+        """
+        Return the time at which this process started, to the resolution
+        of the kernel clock tick
+        :return: start time of this process, or None if it can't be found
+        """
+        try:
+            with open('/proc/self/stat', 'r') as stat:
+                data = stat.read()
+            # Field 22 (starttime), counting from 1, is in clock ticks
+            # since boot; the command name may contain spaces
+            start_ticks = int(data[data.rindex(')') + 2:].split()[19])
+            return time.time() - (time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf('SC_CLK_TCK'))
+        except (OSError, ValueError, IndexError):
+            return None
+
     def _toBool(self, arg, defval: bool = None):
         """
         Parse a string or numerical argument as a bool, based on the following rules:
@@ -286,6 +358,23 @@ class cb_util:
         else:
             return answer
 
+    def _json_dumps(self, ref, **kwargs):
+        """
+        Encode an object as strict JSON, with NaN and infinite values
+        encoded as null and objects that can't be encoded rejected.
+        Normally this is a single pass of the C encoder with no copy of
+        the object; only if the object contains something that the
+        encoder rejects is it walked by _sanitize_json, to convert or
+        report exactly what was found where.
+        :param ref: object to be encoded
+        :param kwargs: other arguments to json.dumps
+        :return: JSON string
+        """
+        try:
+            return json.dumps(ref, allow_nan=False, **kwargs)
+        except (ValueError, TypeError):
+            return json.dumps(self._sanitize_json(ref), allow_nan=False, **kwargs)
+
     def _fsplit(self, string: str):
         return [float(s) for s in string.split()]
 
@@ -305,53 +394,160 @@ class cb_util:
         except Exception as err:
             return f"Can't run {cmd}: {err}"
 
+    def _set_connect_policy(self, initial_backoff: float = None, max_backoff: float = None,
+                            connect_timeout: float = None, max_connecting: int = None):
+        """
+        Set the policy for retrying connections.  Failed connections are
+        retried after a random delay between zero and an exponentially
+        increasing limit (full jitter), so that many clients starting at
+        once don't retry in lock step.
+        :param initial_backoff: limit of the delay before the first retry
+        :param max_backoff: maximum limit of the delay between retries
+        :param connect_timeout: time to wait for a single connection attempt
+        :param max_connecting: maximum number of processes in this pod or
+                               container attempting to connect at once;
+                               0 for no limit
+        """
+        if initial_backoff is not None:
+            self.__connect_policy['initial_backoff'] = initial_backoff
+        if max_backoff is not None:
+            self.__connect_policy['max_backoff'] = max_backoff
+        if connect_timeout is not None:
+            self.__connect_policy['connect_timeout'] = connect_timeout
+        if max_connecting is not None:
+            self.__connect_policy['max_connecting'] = max_connecting
+
+    def _reset_connect_statistics(self):
+        """
+        Reset connection and name lookup statistics, e.g. in a newly
+        forked process so that it doesn't report its parent's
+        connections as its own
+        """
+        self.__connect_stats = {
+            'connects': 0,
+            'connect_retries': 0,
+            'connect_failures': 0,
+            'connect_total_time': 0,
+            'connect_max_time': 0
+            }
+        self._resolver.reset_stats()
+
+    def _connect_statistics(self):
+        """
+        Return statistics about connections made by this process
+        since it was forked
+        """
+        answer = dict(self.__connect_stats)
+        answer['connect_avg_time'] = answer['connect_total_time'] / max(1, answer['connects'])
+        answer.update(self._resolver.stats)
+        return answer
+
+    def __acquire_connect_slot(self):
+        """
+        Wait for one of the max_connecting connection slots shared by
+        the processes of this pod.  Slots are lock files, so they are
+        released even if their holder dies.
+        :return: open slot file, to be closed when done, or None if
+                 connections are not limited
+        """
+        max_connecting = self.__connect_policy['max_connecting']
+        if max_connecting <= 0:
+            return None
+        while True:
+            for slot in range(max_connecting):
+                slot_file = open(f'/tmp/clusterbuster-connect-slot-{slot}', 'a')
+                try:
+                    fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return slot_file
+                except OSError:
+                    slot_file.close()
+            time.sleep(random.uniform(0, 0.01))
+
+    def __connect_once(self, sock, caddr: str, port: int, timeout: float):
+        """
+        Make one connection attempt without blocking for longer than
+        the timeout
+        """
+        sock.setblocking(False)
+        err = sock.connect_ex((caddr, port))
+        if err in (errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK):
+            poller = select.poll()
+            poller.register(sock, select.POLLOUT)
+            if not poller.poll(timeout * 1000):
+                raise TimeoutError(f"Timed out after {timeout:.3f} seconds")
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise ConnectionError(err, os.strerror(err))
+        sock.setblocking(True)
+
     def _connect_to(self, addr: str, port: int, timeout: float = None):
         """
-        Connect to specified address and port.
+        Connect to specified address and port, retrying with backoff
+        as set by _set_connect_policy
         :param addr: address to connect to
         :param port: port to connect to
-        :return: connected socket
+        :param timeout: give up after this long
+        :return: connected socket, or None on timeout
         """
         retries = 0
         initial_time = time.time()
         first_start = self._get_initial_connect_time()
+        backoff = self.__connect_policy['initial_backoff']
         while True:
             try:
-                try:
-                    sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
-                except Exception as err:
-                    self._timestamp(f"Cannot create socket: {err}")
-                    os._exit(1)
-                # We call gethostbyname() each time through the loop because
-                # the remote hostname might not exist immediately.
-                caddr = self._resolve_host(addr)
+                sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+            except Exception as err:
+                self._timestamp(f"Cannot create socket: {err}", level=log_buffer.ERROR)
+                os._exit(1)
+            try:
+                # We resolve the name each time through the loop because
+                # the remote hostname might not exist immediately.  A failed
+                # lookup is retried with the same backoff as the connection.
+                caddr = self._resolve_host(addr, timeout=0)
                 if first_start is None:
                     self.__initial_connect_time = time.time()
-                sock.connect((caddr, port))
+                attempt_timeout = self.__connect_policy['connect_timeout']
+                if timeout:
+                    attempt_timeout = max(0.001, min(attempt_timeout, initial_time + timeout - time.time()))
+                # Hold the connect slot only while connecting, so that a
+                # slow name lookup doesn't hold up other processes.
+                slot = self.__acquire_connect_slot()
+                try:
+                    self.__connect_once(sock, caddr, port, attempt_timeout)
+                finally:
+                    if slot:
+                        slot.close()
+                connect_time = time.time() - initial_time
+                self.__connect_stats['connects'] += 1
+                self.__connect_stats['connect_total_time'] += connect_time
+                self.__connect_stats['connect_max_time'] = max(self.__connect_stats['connect_max_time'], connect_time)
                 if retries:
                     self._timestamp(f"Connected after {retries} retries")
                 return sock
             except Exception as err:
+                sock.close()
                 if timeout and time.time() - initial_time > timeout:
-                    sock.close()
+                    self.__connect_stats['connect_failures'] += 1
                     return None
                 if retries < 10:
                     self._timestamp(f"Cannot connect to {addr} on port {port}: {err}")
                 elif retries == 10:
                     self._timestamp("Printing no further messages")
-                time.sleep(1)
-                retries = retries + 1
-            sock.close()
+            time.sleep(random.uniform(0, backoff))
+            backoff = min(backoff * 2, self.__connect_policy['max_backoff'])
+            retries = retries + 1
+            self.__connect_stats['connect_retries'] += 1
 
-    def _get_port(self, port: int, addr: str = None):
+    def _get_port(self, port: int, addr: str = None, udp: bool = False):
         """
         :param addr: address to bind
         :param port: port to bind to
+        :param udp: bind a UDP rather than a TCP socket
         :return: socket that we have bound
         """
         if addr is None:
             addr = ''
-        sock = socket.socket()
+        sock = socket.socket(type=socket.SOCK_DGRAM if udp else socket.SOCK_STREAM)
         sock.bind((addr, port))
         return sock
 
@@ -378,44 +574,207 @@ class cb_util:
                 self._timestamp(f"Listen failed {exc}, will retry after 10 seconds")
                 time.sleep(10)
 
-    def _resolve_host(self, hostname: str):
+    def _set_resolver_policy(self, ttl: float = None, shared: bool = None):
+        """
+        Set the policy for caching host name resolutions
+        :param ttl: time to cache successful lookups
+        :param shared: share the cache between the processes of the pod
+        """
+        if ttl is not None:
+            self._resolver.ttl = ttl
+        if shared is not None:
+            self._resolver.path = resolver_cache.default_path if shared else None
+
+    def _resolve_host(self, hostname: str, timeout: float = None):
         """
-        Resolve a host name to dotted quad IP address, retrying as needed
+        Resolve a host name to dotted quad IP address, retrying as needed.
+        Results, including failures, are cached.
         :param hostname: Host name to resolve
+        :param timeout: Give up after this long, raising socket.gaierror;
+                        0 to try only once
         :return: Dotted-quad string representation of hostname
         """
         if re.match(r'([0-9]{1,3}\.){3}[0-9]{1,3}', hostname):
             return hostname
+        start = time.time()
         while True:
+            entry = self._resolver.lookup(hostname)
+            if entry is None:
+                try:
+                    addr = socket.gethostbyname(hostname)
+                    self._resolver.update(hostname, addr)
+                    return addr
+                except socket.gaierror as err:
+                    self._timestamp(f"gethostbyname({hostname}) failed: {err}")
+                    entry = self._resolver.update(hostname)
+            elif entry['addr'] is not None:
+                return entry['addr']
+            if timeout is not None and time.time() - start >= timeout:
+                raise socket.gaierror(f"Unable to resolve {hostname}")
+            delay = entry['expires'] - time.time()
+            if timeout is not None:
+                delay = min(delay, start + timeout - time.time())
+            if delay > 0:
+                time.sleep(delay)
+
+    def __recv_exactly(self, sock, nbytes: int, eof_ok: bool = False):
+        """
+        Read exactly the requested number of bytes from a socket
+        :param sock: socket to read from
+        :param nbytes: number of bytes to read
+        :param eof_ok: return None rather than failing if the connection
+                       is closed before anything is read
+        :return: bytes read
+        """
+        answer = bytearray(nbytes)
+        view = memoryview(answer)
+        offset = 0
+        while offset < nbytes:
+            nread = sock.recv_into(view[offset:], nbytes - offset)
+            if nread == 0:
+                if eof_ok and offset == 0:
+                    return None
+                raise ConnectionError(f"Connection closed with {nbytes - offset} bytes left at {offset}")
+            offset += nread
+        return answer
+
+    def __recv_frame(self, sock):
+        """
+        Read a binary frame from a socket
+        :return: (request ID, payload), or None if the connection
+                 was closed without a reply
+        """
+        header = self.__recv_exactly(sock, sync_connection.header.size, eof_ok=True)
+        if header is None:
+            return None
+        magic, flags, reqid, nbytes = sync_connection.header.unpack(header)
+        if magic != sync_connection.magic:
+            raise ValueError(f"Bad frame header {bytes(header)}")
+        payload = self.__recv_exactly(sock, nbytes)
+        if flags & sync_connection.flag_compressed:
+            payload = zlib.decompress(payload)
+        return reqid, bytes(payload)
+
+    def __send_session_message(self, host: str, port: int, token: list, timeout: float = None,
+                               binary: bool = False, compress: bool = False):
+        """
+        Send a framed token over a persistent session to host:port,
+        opening the session if needed, and wait for the reply to it.
+        Sessions are per process; a session inherited across fork()
+        belongs to the parent and is not used.
+        :return: reply, or None if the connection timed out
+        """
+        session = self.__sessions.get((host, port))
+        if session is not None and session['pid'] != os.getpid():
+            session['sock'].close()
+            session = None
+        if session is None:
+            self._timestamp(f'Opening sync session to {host}:{port}')
+            sock = self._connect_to(host, port, timeout=timeout)
+            if sock is None:
+                return None
+            session = {'sock': sock, 'pid': os.getpid(), 'reqid': 0}
+            self.__sessions[(host, port)] = session
+        session['reqid'] += 1
+        reqid = session['reqid']
+        sock = session['sock']
+        try:
+            sock.settimeout(timeout)
+            if binary:
+                sync_connection.sendall(sock, sync_connection.frame(token, reqid, compress=compress,
+                                                                    accept_compressed=compress))
+            else:
+                token = [f'{reqid} '.encode()] + token
+                sync_connection.sendall(sock, [('0x%08x' % sum(len(buf) for buf in token)).encode()] + token)
+            while True:
+                if binary:
+                    frame = self.__recv_frame(sock)
+                    if frame is None:
+                        raise ConnectionError("Connection closed awaiting reply")
+                    answer_reqid, answer = frame
+                else:
+                    nbytes = int(self.__recv_exactly(sock, 10), base=16)
+                    answer_reqid, sep, answer = bytes(self.__recv_exactly(sock, nbytes)).partition(b' ')
+                if int(answer_reqid) == reqid:
+                    return answer
+                self._timestamp(f'Discarding stale reply to request {int(answer_reqid)} (expected {reqid})')
+        except Exception:
+            self._close_sessions()
+            raise
+
+    def _close_sessions(self):
+        """
+        Close any persistent sessions owned by this process
+        """
+        for session in self.__sessions.values():
             try:
-                return socket.gethostbyname(hostname)
-            except socket.gaierror as err:
-                self._timestamp(f"gethostbyname({hostname}) failed: {err}")
-                time.sleep(1)
+                session['sock'].close()
+            except Exception:
+                pass
+        self.__sessions = {}
 
-    def _send_message(self, host: str, port: int, token: str, timeout: float = None):
+    def _send_message(self, host: str, port: int, token, timeout: float = None, persistent: bool = False,
+                      binary: bool = False, compress: bool = False, prefix: str = ''):
+        """
+        Send a token to host:port and wait for the reply
+        :param token: Text, or bytes or a list of buffers, to send
+        :param prefix: Text (e.g. nonce and command) preceding the token;
+                       it is sent as a separate buffer rather than
+                       being joined to the token
+        :param persistent: Use a persistent session rather than
+                           a new connection for each message
+        :param binary: Use binary rather than legacy framing
+        :param compress: Compress large messages (binary framing only),
+                         and accept compressed replies
+        :return: reply, or None on timeout
+        """
         initial_time = time.time()
-        token = ('0x%08x%s' % (len(token), token)).encode()
+        if isinstance(token, str):
+            token = token.encode()
+        if not isinstance(token, list):
+            token = [token]
+        token = [buf for buf in [prefix.encode()] + token if len(buf)]
+        token_length = sum(len(buf) for buf in token)
+        if persistent:
+            while True:
+                try:
+                    self._timestamp(f'sync session {host}:{port} token length {token_length}')
+                    answer = self.__send_session_message(host, port, token, timeout=timeout,
+                                                         binary=binary, compress=compress)
+                    if answer is None:
+                        self._timestamp("Write token failed: timed out")
+                    return answer
+                except Exception as err:
+                    if timeout and time.time() - initial_time > timeout:
+                        self._timestamp(f'sync failed {err}, timeout expired')
+                        return None
+                    self._timestamp(f'sync session failed {err}, retrying')
+                    time.sleep(1)
+        if binary:
+            buffers = sync_connection.frame(token, compress=compress, accept_compressed=compress)
+        else:
+            buffers = [('0x%08x' % token_length).encode()] + token
         while True:
             self._timestamp(f'sync {port}:{port}')
             sync_conn = self._connect_to(host, port, timeout=timeout)
-            while len(token) > 0:
-                if len(token) > 128:
-                    self._timestamp(f'Writing {len(token)} bytes to sync')
+            if not sync_conn:
+                self._timestamp("Write token failed: timed out")
+                return None
+            if token_length > 128:
+                self._timestamp(f'Writing {sum(len(buf) for buf in buffers)} bytes to sync')
+            else:
+                self._timestamp(f'Writing token {b"".join(token).decode("utf-8", errors="replace")} to sync')
+            try:
+                sync_connection.sendall(sync_conn, buffers)
+                if binary:
+                    frame = self.__recv_frame(sync_conn)
+                    answer = frame[1] if frame else b''
                 else:
-                    self._timestamp(f'Writing token {token.decode("utf-8")} to sync')
-                if sync_conn:
-                    answer = sync_conn.send(token)
-                    if answer <= 0:
-                        self._timestamp("Write token failed")
-                    else:
-                        token = token[answer:]
+                    answer = sync_conn.recv(1024)
+                if len(answer) > 1024:
+                    self._timestamp(f'sync complete, response {len(answer)} bytes')
                 else:
-                    self._timestamp("Write token failed: timed out")
-                    return None
-            try:
-                answer = sync_conn.recv(1024)
-                self._timestamp(f'sync complete, response {answer.decode("utf-8")}')
+                    self._timestamp(f'sync complete, response {answer.decode("utf-8")}')
                 return answer
             except Exception as err:
                 if timeout and time.time() - initial_time > timeout:
@@ -457,3 +816,907 @@ class cb_util:
                         except Exception:
                             pass
         return answers
+
+
+class sync_connection:
+    """
+    A client connection to the sync server (or a sync aggregator).
+    Data is read as it becomes available, directly into a buffer
+    preallocated for the frame, so that a slow or half-open client does
+    not hold up the other clients of a barrier.
+
+    Two framings are accepted:
+    - legacy: '0x%08x' length followed by the token
+    - binary: a fixed header (magic, flags, request ID, payload length)
+      followed by the payload, which may be zlib-compressed.
+    Replies use the framing of the request they answer.
+
+    The payload of an aggregated request (command 'aggr') combines the
+    payloads of several requests for one command: a header (command,
+    count, and the length of each payload) followed by the payloads.
+
+    A connection is either one-shot, carrying a single token and
+    released by closing it, or a persistent session carrying any number
+    of tokens.  Each token on a session carries a request ID (a numeric
+    prefix on legacy frames, a header field on binary frames), which is
+    echoed back in a framed reply.
+    """
+    header = struct.Struct('!4sBII')
+    magic = b'\0CBF'
+    # Payload is zlib-compressed
+    flag_compressed = 1
+    # Sender accepts a compressed reply
+    flag_accept_compressed = 2
+    # Payloads smaller than this are never compressed
+    compress_threshold = 4096
+    legacy_header_size = 10
+    aggregate_header = struct.Struct('!4sI')
+
+    def __init__(self, sock, address, reply_timeout: float = 30):
+        self.sock = sock
+        self.address = address
+        self.reply_timeout = reply_timeout
+        self.header_buf = bytearray(sync_connection.header.size)
+        self.header_size = sync_connection.legacy_header_size
+        self.header_read = 0
+        self.payload = None
+        self.payload_read = 0
+        self.binary = False
+        self.flags = 0
+        self.session = False
+        self.reqid = None
+
+    @staticmethod
+    def frame(payload, reqid: int = 0, compress: bool = False, accept_compressed: bool = False):
+        """
+        Build a binary frame
+        :param payload: data to send, either bytes or a list of buffers
+                        that are sent back to back without being joined
+        :param reqid: session request ID, or 0 for a one-shot message
+        :param compress: compress the payload if it is large enough to benefit
+        :param accept_compressed: tell the receiver it may compress its reply
+        :return: list of buffers making up the frame
+        """
+        if not isinstance(payload, list):
+            payload = [payload]
+        flags = sync_connection.flag_accept_compressed if accept_compressed else 0
+        nbytes = sum(len(buf) for buf in payload)
+        if compress and nbytes >= sync_connection.compress_threshold:
+            compressor = zlib.compressobj(1)
+            compressed = b''.join([compressor.compress(buf) for buf in payload] + [compressor.flush()])
+            if len(compressed) < nbytes:
+                payload = [compressed]
+                nbytes = len(compressed)
+                flags |= sync_connection.flag_compressed
+        return [sync_connection.header.pack(sync_connection.magic, flags, reqid, nbytes)] + payload
+
+    @staticmethod
+    def sendall(sock, buffers: list):
+        """
+        Send a list of buffers with as few system calls as possible
+        and without first joining them
+        """
+        views = [memoryview(buf) for buf in buffers if len(buf)]
+        while views:
+            nbytes = sock.sendmsg(views)
+            while views and nbytes >= len(views[0]):
+                nbytes -= len(views[0])
+                views.pop(0)
+            if nbytes:
+                views[0] = views[0][nbytes:]
+
+    def __parse_header(self):
+        header = self.header_buf
+        if header[:4] == sync_connection.magic:
+            if self.header_size < sync_connection.header.size:
+                self.header_size = sync_connection.header.size
+                return
+            magic, self.flags, reqid, nbytes = sync_connection.header.unpack(header)
+            self.binary = True
+            if reqid:
+                self.session = True
+                self.reqid = reqid
+        else:
+            prefix = header[:self.header_size].decode('ascii', errors='replace').lower()
+            if not re.match(r'0x[0-9a-z]{8}', prefix):
+                raise ValueError(f"Bad token: {prefix}")
+            nbytes = int(prefix, base=16)
+            self.binary = False
+        self.payload = bytearray(nbytes)
+        self.payload_read = 0
+
+    def __complete_token(self):
+        payload = self.payload
+        if self.binary and self.flags & sync_connection.flag_compressed:
+            payload = zlib.decompress(payload)
+        self.payload = None
+        self.header_read = 0
+        self.header_size = sync_connection.legacy_header_size
+        token = memoryview(payload)
+        if not self.binary:
+            sep = payload.find(b' ', 0, 12)
+            if sep > 0 and payload[:sep].isdigit():
+                self.session = True
+                self.reqid = payload[:sep].decode('ascii')
+                token = token[sep + 1:]
+        return token
+
+    @staticmethod
+    def split_token(token: memoryview):
+        """
+        Split a token into its nonce, command, and payload without
+        copying the payload, which is typically the bulk of the token
+        :return: nonce (bytes), command (lower case), payload
+        """
+        head = bytes(token[:128])
+        nonce, sep, rest = head.partition(b' ')
+        if not sep:
+            raise ValueError(f"No command in token {head.decode('utf-8', errors='replace')}")
+        command = rest[:4]
+        offset = len(nonce) + len(sep) + len(command)
+        while offset < len(token) and token[offset] in b' \t\r\n':
+            offset += 1
+        return nonce, command.decode('utf-8', errors='replace').lower(), token[offset:]
+
+    @staticmethod
+    def aggregate(command: str, payloads: list):
+        """
+        Combine the payloads of several requests for the same command
+        into the payload of one aggregated request, without copying them
+        :return: list of buffers making up the aggregated payload
+        """
+        return [sync_connection.aggregate_header.pack(command.encode('ascii'), len(payloads)),
+                struct.pack(f'!{len(payloads)}I', *[len(payload) for payload in payloads])] + payloads
+
+    @staticmethod
+    def split_aggregate(payload: memoryview):
+        """
+        Split the payload of an aggregated request without copying it
+        :return: command (lower case), list of payloads
+        """
+        offset = sync_connection.aggregate_header.size
+        command, count = sync_connection.aggregate_header.unpack(payload[:offset])
+        lengths = struct.unpack(f'!{count}I', payload[offset:offset + 4 * count])
+        offset += 4 * count
+        payloads = []
+        for length in lengths:
+            payloads.append(payload[offset:offset + length])
+            offset += length
+        if offset != len(payload):
+            raise ValueError(f"Aggregated payload length {len(payload)} does not match its header ({offset})")
+        return command.decode('ascii').lower(), payloads
+
+    def read(self):
+        """
+        Read whatever data is available from the client
+        :return: the complete token once it has been read, '' if the
+                 client closed the connection between tokens,
+                 or None if more data is required.
+        """
+        token = self.read_token()
+        if token is None:
+            return None
+        return str(token, 'utf-8')
+
+    def read_token(self):
+        """
+        As read(), but return a complete token as a memoryview of the
+        bytes received (b'' if the client closed the connection),
+        leaving it to the caller to decode what it needs
+        """
+        while True:
+            try:
+                if self.payload is None:
+                    with memoryview(self.header_buf) as view:
+                        nbytes = self.sock.recv_into(view[self.header_read:self.header_size])
+                elif self.payload_read < len(self.payload):
+                    with memoryview(self.payload) as view:
+                        nbytes = self.sock.recv_into(view[self.payload_read:])
+                else:
+                    return self.__complete_token()
+            except (BlockingIOError, InterruptedError):
+                return None
+            except Exception as exc:
+                raise ValueError(f"Bad read at offset {self.header_read + self.payload_read}: {exc}")
+            if nbytes == 0:
+                if self.payload is None and self.header_read == 0:
+                    return b''
+                raise ValueError(f"Short read: got zero bytes at {self.header_read + self.payload_read}")
+            if self.payload is None:
+                self.header_read += nbytes
+                if self.header_read == self.header_size:
+                    self.__parse_header()
+            else:
+                self.payload_read += nbytes
+
+    def reply(self, data: bytes = b''):
+        """
+        Send a reply to the client, framed as its request was.
+        On a session, the reply is tagged with the ID of the request
+        it answers.
+        """
+        if self.binary:
+            buffers = sync_connection.frame(data, self.reqid or 0,
+                                            compress=bool(self.flags & sync_connection.flag_accept_compressed))
+            self.reqid = None
+        elif self.session:
+            prefix = f'{self.reqid} '.encode('ascii')
+            buffers = [('0x%08x' % (len(prefix) + len(data))).encode('ascii'), prefix, data]
+            self.reqid = None
+        else:
+            buffers = [data]
+        self.sock.settimeout(self.reply_timeout)
+        try:
+            sync_connection.sendall(self.sock, buffers)
+        finally:
+            self.sock.setblocking(False)
+
+    def release(self):
+        """
+        Release the client from a barrier.  One-shot clients are released
+        by closing the connection; sessions by replying to their request
+        if that has not already been done.
+        """
+        if not self.session:
+            self.sock.close()
+        elif self.reqid is not None:
+            self.reply()
+
+
+class resolver_cache:
+    """
+    Cache of host name resolutions, shared by all of the processes of a
+    pod through a small file, so that each name is looked up once per TTL
+    per pod rather than on every connection attempt by every process.
+    Failed lookups are cached too, for an interval that doubles with each
+    consecutive failure, so that a name that doesn't exist yet isn't
+    looked up in a tight loop.
+
+    The file is replaced atomically by rename, so readers need no lock;
+    writers serialize on a separate lock file.  If the path is None,
+    the cache is private to the process.
+    """
+    default_path = '/tmp/clusterbuster-resolver-cache.json'
+
+    def __init__(self, path: str = default_path, ttl: float = 60,
+                 negative_ttl: float = 0.5, max_negative_ttl: float = 8):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_negative_ttl = max_negative_ttl
+        self.entries = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {
+            'resolver_lookups': 0,
+            'resolver_hits': 0,
+            'resolver_negative_hits': 0
+            }
+
+    def __load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r') as cache:
+                self.entries.update(json.load(cache))
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def lookup(self, name: str):
+        """
+        Look up a name in the cache
+        :param name: name to look up
+        :return: unexpired cache entry ({'addr', 'expires', 'failures'},
+                 with addr None for a failed lookup), or None
+        """
+        now = time.time()
+        entry = self.entries.get(name)
+        if entry is None or entry['expires'] <= now:
+            self.__load()
+            entry = self.entries.get(name)
+        if entry is None or entry['expires'] <= now:
+            return None
+        if entry['addr'] is None:
+            self.stats['resolver_negative_hits'] += 1
+        else:
+            self.stats['resolver_hits'] += 1
+        return entry
+
+    def update(self, name: str, addr: str = None, ttl: float = None):
+        """
+        Record the result of a lookup
+        :param name: name looked up
+        :param addr: address found, or None if the lookup failed
+        :param ttl: time to cache a successful lookup, if not the default
+        :return: the new cache entry
+        """
+        self.stats['resolver_lookups'] += 1
+        previous = self.entries.get(name)
+        if addr is None:
+            failures = previous['failures'] + 1 if previous and previous['addr'] is None else 1
+            ttl = min(self.max_negative_ttl, self.negative_ttl * 2 ** (failures - 1))
+        else:
+            failures = 0
+            if ttl is None:
+                ttl = self.ttl
+        entry = {'addr': addr, 'expires': time.time() + ttl, 'failures': failures}
+        self.entries[name] = entry
+        if not self.path:
+            return entry
+        try:
+            with open(f'{self.path}.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self.__load()
+                self.entries[name] = entry
+                # Don't let expired entries accumulate
+                now = time.time()
+                self.entries = {key: val for key, val in self.entries.items() if val['expires'] > now}
+                tmpfile = f'{self.path}.{os.getpid()}'
+                with open(tmpfile, 'w') as cache:
+                    json.dump(self.entries, cache)
+                os.rename(tmpfile, self.path)
+        except OSError:
+            pass
+        return entry
+
+
+class log_buffer:
+    """
+    Leveled, buffered log output.  Messages at or above the output level
+    are queued and written to stderr in batches, when the batch fills,
+    when the oldest queued message is older than the flush interval, or
+    when explicitly flushed, so that logging from inside a measurement
+    costs little more than appending to a list.  A background thread
+    writes out messages that reach the flush interval while nothing
+    else is logged, e.g. while the caller sleeps.  Messages below the
+    output level are kept in a bounded ring so that recent history can
+    still be dumped if the run fails.
+
+    Formatting is deferred until the batch is written; the date and time
+    to the second are formatted only once per second.  Pending output is
+    flushed before fork and at exit so that it is neither duplicated nor
+    lost.
+    """
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+    levels = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+    indent_re = re.compile(r'\n(.*\S.*)')
+
+    def __init__(self, level: int = INFO, batch: int = 64, flush_interval: float = 1,
+                 history: int = 256, timestamps: bool = True):
+        self.level = level
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.timestamps = timestamps
+        self.pending = []
+        self.history = deque(maxlen=history)
+        self.first_pending = None
+        # Reentrant, in case a signal handler logs during a flush
+        self.lock = threading.RLock()
+        self.pid = os.getpid()
+        self.second = (None, None)
+        _live_log_buffers.add(self)
+
+    def reset_pid(self):
+        """
+        Prepare to log from a newly forked child
+        """
+        self.pid = os.getpid()
+        self.second = (None, None)
+        # The lock may have been held by another thread at fork
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def parse_level(level):
+        """
+        Convert a level name or number to a level number
+        :param level: level name (debug, info, warning, error) or number
+        :return: level number
+        """
+        try:
+            return int(level)
+        except ValueError:
+            return log_buffer.levels[str(level).lower()]
+
+    def format(self, t: float, string: str, args: tuple = ()):
+        """
+        Format one message
+        :param t: time of message (already adjusted for any offset)
+        :param string: message, or format string if args are present
+        :param args: arguments to be formatted into string
+        :return: formatted message with trailing newline
+        """
+        if args:
+            string = string % args
+        if not self.timestamps:
+            return f'{string}\n'
+        if '\n' in string:
+            string = self.indent_re.sub(r'\n            \1', string)
+        second = int(t)
+        # Cached as one tuple, since messages may be formatted by more
+        # than one thread
+        cached_second, prefix = self.second
+        if second != cached_second:
+            prefix = '%7d %s' % (self.pid, datetime.utcfromtimestamp(second).strftime('%Y-%m-%dT%T'))
+            self.second = (second, prefix)
+        return '%s.%06d %s\n' % (prefix, int((t - second) * 1000000), string)
+
+    def log(self, t: float, level: int, string: str, args: tuple = ()):
+        """
+        Log a message
+        :param t: time of message (already adjusted for any offset)
+        :param level: level of message
+        :param string: message, or format string if args are present
+        :param args: arguments to be formatted into string when written
+        """
+        if level < self.level:
+            self.history.append((t, string, args))
+            return
+        with self.lock:
+            now = time.monotonic()
+            if not self.pending:
+                self.first_pending = now
+                _start_log_flusher()
+            self.pending.append((t, string, args))
+            if level >= self.ERROR or len(self.pending) >= self.batch or now - self.first_pending >= self.flush_interval:
+                self.flush()
+
+    def flush(self, stale_only: bool = False):
+        """
+        Write out all pending messages
+        :param stale_only: Only write them out if the oldest has been
+                           pending for at least the flush interval
+        """
+        with self.lock:
+            if not self.pending:
+                return
+            if stale_only and time.monotonic() - self.first_pending < self.flush_interval:
+                return
+            pending = self.pending
+            self.pending = []
+            self.__write(pending)
+
+    def dump_history(self):
+        """
+        Write out pending messages followed by retained messages that
+        were below the output level, e.g. upon failure
+        """
+        with self.lock:
+            self.flush()
+            if not self.history:
+                return
+            history = list(self.history)
+            self.history.clear()
+            self.__write([(history[0][0], f'Last {len(history)} messages below log level:', ())] + history)
+
+    def __write(self, records: list):
+        # Formatting is deferred, so a message whose arguments don't
+        # match its format string is only found here; write it as best
+        # we can rather than losing the rest of the batch with it.
+        lines = []
+        for t, string, args in records:
+            try:
+                lines.append(self.format(t, string, args))
+            except Exception:
+                lines.append(self.format(t, f'{string} {args!r}'))
+        try:
+            sys.stderr.write(''.join(lines))
+            sys.stderr.flush()
+        except Exception:
+            pass
+
+
+# Fork and exit hooks can't be unregistered, so they are registered
+# once for all buffers rather than by each buffer.
+_live_log_buffers = weakref.WeakSet()
+
+
+def _flush_log_buffers():
+    for buf in list(_live_log_buffers):
+        buf.flush()
+
+
+def _reset_log_buffers():
+    global _log_flusher
+    _log_flusher = None
+    for buf in list(_live_log_buffers):
+        buf.reset_pid()
+
+
+_log_flusher = None
+
+
+def _run_log_flusher():
+    while True:
+        interval = min([buf.flush_interval for buf in list(_live_log_buffers)] or [1])
+        time.sleep(min(max(interval / 2, .01), 1))
+        for buf in list(_live_log_buffers):
+            buf.flush(stale_only=True)
+
+
+def _start_log_flusher():
+    """
+    Start the thread that writes out messages that have been pending
+    for the flush interval, if it isn't already running in this process
+    """
+    global _log_flusher
+    if _log_flusher is None:
+        _log_flusher = threading.Thread(target=_run_log_flusher, name='log-flusher', daemon=True)
+        _log_flusher.start()
+
+
+os.register_at_fork(before=_flush_log_buffers, after_in_child=_reset_log_buffers)
+atexit.register(_flush_log_buffers)
+
+
+class sampling_profiler:
+    """
+    Statistical profiler driven by an interval timer.  Each time the
+    timer fires, the Python stack that was running is recorded as a
+    collapsed stack (outermost frame first, frames separated by
+    semicolons, as consumed by flame graph tools) and counted.
+
+    In cpu mode the timer runs on the CPU time of the process
+    (ITIMER_PROF), so only time spent running is sampled; in wall mode
+    it runs on elapsed time (ITIMER_REAL), so time spent waiting, e.g.
+    on the system under test, is sampled too.  Interval timers are not
+    inherited across fork, so only the calling process is profiled.
+    """
+    timers = {
+        'cpu': (signal.ITIMER_PROF, signal.SIGPROF),
+        'wall': (signal.ITIMER_REAL, signal.SIGALRM)
+        }
+    max_depth = 64
+
+    def __init__(self, mode: str = 'cpu', interval: float = 0.01):
+        self.mode = mode
+        self.which, self.signum = self.timers[mode]
+        self.interval = interval
+        self.samples = 0
+        self.stacks = {}
+        self.names = {}
+        self.previous_handler = None
+        self.running = False
+
+    def __sample(self, signum, frame):
+        names = self.names
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            name = names.get(code)
+            if name is None:
+                name = f'{os.path.basename(code.co_filename)}:{code.co_name}'
+                names[code] = name
+            stack.append(name)
+            frame = frame.f_back
+        stack.reverse()
+        key = ';'.join(stack)
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def start(self):
+        """
+        Start sampling
+        """
+        if not self.running:
+            self.previous_handler = signal.signal(self.signum, self.__sample)
+            signal.setitimer(self.which, self.interval, self.interval)
+            self.running = True
+
+    def stop(self):
+        """
+        Stop sampling
+        """
+        if self.running:
+            signal.setitimer(self.which, 0)
+            signal.signal(self.signum, self.previous_handler)
+            self.running = False
+
+    def summary(self, max_stacks: int = 100):
+        """
+        Summarize the profile
+        :param max_stacks: maximum number of distinct stacks to report
+        :return: {'mode', 'interval', 'samples', 'stacks'}, with the
+                 most frequently sampled stacks and their sample counts
+        """
+        stacks = sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)[:max_stacks]
+        return {
+            'mode': self.mode,
+            'interval': self.interval,
+            'samples': self.samples,
+            'stacks': dict(stacks)
+            }
+
+
+class resource_sampler:
+    """
+    Sample the resource usage of the pod's cgroup (v2) and of the
+    calling process at a fixed interval on a background thread, for
+    time resolution that metrics scraped from outside the pod can't
+    provide.  Files are kept open and re-read with pread, so each
+    sample costs a handful of system calls.
+
+    Each value is recorded as reported by the kernel (counters are
+    cumulative) in its own array, aligned with the array of sample
+    times.  If max_samples is reached, every other sample is discarded
+    and the interval doubled, so that long runs stay bounded.
+    """
+    max_samples = 4096
+    cgroup_roots = ('/sys/fs/cgroup', '/sys/fs/cgroup/unified')
+    cpu_stat_keys = ('usage_usec', 'user_usec', 'system_usec', 'nr_periods', 'nr_throttled', 'throttled_usec')
+    memory_stat_keys = ('anon', 'file', 'kernel', 'shmem', 'pgfault', 'pgmajfault',
+                        'workingset_refault_anon', 'workingset_refault_file')
+    io_stat_keys = ('rbytes', 'wbytes', 'rios', 'wios')
+    # Fields of /proc/self/stat, numbered from 1 as in proc(5)
+    proc_stat_fields = {'minflt': 10, 'majflt': 12, 'utime': 14, 'stime': 15, 'num_threads': 20, 'rss': 24}
+
+    def __init__(self, interval: float, timer=time.time):
+        self.requested_interval = interval
+        self.interval = interval
+        self.timer = timer
+        self.cgroup = self.find_cgroup()
+        self.files = {}
+        self.samples = {'time': []}
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+
+    @classmethod
+    def find_cgroup(cls):
+        """
+        Find the cgroup v2 directory of this process
+        :return: path of the cgroup directory, or None if there is no
+                 cgroup v2 hierarchy
+        """
+        path = '/'
+        try:
+            with open('/proc/self/cgroup', 'r') as cgroups:
+                for line in cgroups:
+                    if line.startswith('0::'):
+                        path = line[3:].strip()
+                        break
+        except OSError:
+            pass
+        for root in cls.cgroup_roots:
+            for candidate in (os.path.normpath(os.path.join(root, path.lstrip('/'))), root):
+                if os.path.isfile(os.path.join(candidate, 'cgroup.controllers')):
+                    return candidate
+        return None
+
+    def __open(self):
+        files = {'proc': '/proc/self/stat'}
+        if self.cgroup:
+            for name in ('cpu.stat', 'memory.current', 'memory.stat', 'io.stat',
+                         'cpu.pressure', 'memory.pressure', 'io.pressure'):
+                files[name] = os.path.join(self.cgroup, name)
+        for name, path in files.items():
+            try:
+                self.files[name] = os.open(path, os.O_RDONLY)
+            except OSError:
+                pass
+
+    @staticmethod
+    def __keyvals(data: str, keys: tuple, prefix: str, values: dict):
+        for line in data.splitlines():
+            key, _, val = line.partition(' ')
+            if key in keys:
+                values[f'{prefix}{key}'] = int(val)
+
+    def __parse(self, name: str, data: str, values: dict):
+        if name == 'proc':
+            # The command name may contain spaces
+            fields = data[data.rindex(')') + 2:].split()
+            for key, field in self.proc_stat_fields.items():
+                values[f'proc_{key}'] = int(fields[field - 3])
+            values['proc_utime'] = round(values['proc_utime'] / self.clock_ticks, 3)
+            values['proc_stime'] = round(values['proc_stime'] / self.clock_ticks, 3)
+            values['proc_rss'] *= self.page_size
+        elif name == 'cpu.stat':
+            self.__keyvals(data, self.cpu_stat_keys, 'cpu_', values)
+        elif name == 'memory.current':
+            values['memory_current'] = int(data)
+        elif name == 'memory.stat':
+            self.__keyvals(data, self.memory_stat_keys, 'memory_', values)
+        elif name == 'io.stat':
+            # One line per device; report the totals
+            for line in data.splitlines():
+                for field in line.split()[1:]:
+                    key, _, val = field.partition('=')
+                    if key in self.io_stat_keys:
+                        values[f'io_{key}'] = values.get(f'io_{key}', 0) + int(val)
+        elif name.endswith('.pressure'):
+            resource = name.split('.')[0]
+            for line in data.splitlines():
+                fields = line.split()
+                if fields and fields[-1].startswith('total='):
+                    values[f'{resource}_pressure_{fields[0]}_usec'] = int(fields[-1][6:])
+
+    def sample(self):
+        """
+        Take one sample
+        """
+        values = {}
+        for name, fd in self.files.items():
+            try:
+                self.__parse(name, os.pread(fd, 65536, 0).decode(), values)
+            except (OSError, ValueError, IndexError):
+                pass
+        with self.lock:
+            samples = self.samples
+            count = len(samples['time'])
+            samples['time'].append(round(self.timer(), 6))
+            for key, val in values.items():
+                if key not in samples:
+                    samples[key] = [None] * count
+                samples[key].append(val)
+            for key, array in samples.items():
+                if len(array) == count:
+                    array.append(None)
+            if count + 1 >= self.max_samples:
+                for array in samples.values():
+                    del array[1::2]
+                self.interval *= 2
+
+    def __run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        """
+        Start sampling
+        """
+        self.__open()
+        self.sample()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop sampling, taking a final sample
+        """
+        if self.thread:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+            self.sample()
+            for fd in self.files.values():
+                os.close(fd)
+            self.files = {}
+
+    def summary(self):
+        """
+        :return: the samples, with the sampling parameters
+        """
+        with self.lock:
+            return {
+                'cgroup': self.cgroup,
+                'requested_interval': self.requested_interval,
+                'interval': self.interval,
+                'samples': len(self.samples['time']),
+                'values': dict(self.samples)
+                }
+
+
+class tree_cleaner:
+    """
+    Remove the contents of directory trees with a bounded pool of
+    threads.  Directories are scanned with os.scandir, whose d_type
+    information distinguishes files from directories without a stat
+    per entry; files are unlinked as they are found, with each
+    directory scanned by whichever thread is free.  Once the whole
+    tree has been scanned, directories are removed deepest first,
+    again in parallel.
+
+    Errors are counted rather than raised, and entries that have
+    already disappeared are ignored, so that several processes can
+    clean the same tree concurrently.
+    """
+    def __init__(self, threads: int = 8):
+        self.threads = max(threads, 1)
+        self.lock = threading.Lock()
+        self.__reset()
+
+    def __reset(self):
+        self.entries = 0
+        self.errors = 0
+        self.dirs = []
+
+    def __count(self, entries: int = 0, errors: int = 0, dirs: list = None):
+        with self.lock:
+            self.entries += entries
+            self.errors += errors
+            if dirs:
+                self.dirs.extend(dirs)
+
+    def __scan(self, item: tuple, work: queue.Queue):
+        path, depth = item
+        entries = 0
+        errors = 0
+        dirs = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append((depth + 1, entry.path))
+                            work.put((entry.path, depth + 1))
+                        else:
+                            os.unlink(entry.path)
+                            entries += 1
+                    except FileNotFoundError:
+                        pass
+                    except OSError:
+                        errors += 1
+        except FileNotFoundError:
+            pass
+        except OSError:
+            errors += 1
+        self.__count(entries, errors, dirs)
+
+    def __rmdir(self, path: str, work: queue.Queue):
+        try:
+            os.rmdir(path)
+            self.__count(entries=1)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            self.__count(errors=1)
+
+    def __worker(self, work: queue.Queue, func):
+        while True:
+            item = work.get()
+            try:
+                if item is None:
+                    return
+                func(item, work)
+            finally:
+                work.task_done()
+
+    def __run(self, items: list, func, nthreads: int):
+        """
+        Apply func to each of the items, and to anything that func
+        adds to the work queue, until the queue is drained.
+        """
+        work = queue.Queue()
+        for item in items:
+            work.put(item)
+        threads = [threading.Thread(target=self.__worker, args=(work, func), daemon=True)
+                   for i in range(max(min(nthreads, self.threads), 1))]
+        for thread in threads:
+            thread.start()
+        work.join()
+        for thread in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+
+    def clean(self, tree: str, remove_root: bool = False):
+        """
+        Remove everything below tree
+        :param tree: Directory to be cleaned
+        :param remove_root: Also remove tree itself
+        :return: dict of the number of entries removed, the number of
+                 errors, and the elapsed time in seconds
+        """
+        start = time.perf_counter()
+        self.__reset()
+        # Scanning can fan out to any number of directories, so all
+        # threads are started.
+        self.__run([(tree, 0)], self.__scan, self.threads)
+        by_depth = {}
+        for depth, path in self.dirs:
+            by_depth.setdefault(depth, []).append(path)
+        for depth in sorted(by_depth.keys(), reverse=True):
+            self.__run(by_depth[depth], self.__rmdir, len(by_depth[depth]))
+        if remove_root:
+            self.__rmdir(tree, None)
+        return {
+            'entries': self.entries,
+            'errors': self.errors,
+            'seconds': time.perf_counter() - start
+            }
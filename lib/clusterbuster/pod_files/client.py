@@ -47,12 +47,18 @@ class client_client(clusterbuster_pod_client):
         if xfertime != self.xfertime_max:
             xfertime += random.randint(0, self.xfertime_max - xfertime)
 
+        # Latencies are measured in integer nanoseconds on the monotonic
+        # clock, and converted to seconds only at the end.
+        now_ns = self._monotonic_ns
         user, system = self._cputimes()
-        data_start_time = self._adjusted_time()
-        time_overhead = self._calibrate_time()
-        starttime = data_start_time
-        while (nbytes > 0 and data_sent < bytes) or (xfertime > 0 and self._adjusted_time() - data_start_time < xfertime):
-            rtt_start = self._adjusted_time()
+        data_start_ns = now_ns()
+        time_overhead_ns = self._calibrate_time_ns()
+        end_ns = data_start_ns + int(xfertime * 1000000000) if xfertime > 0 else None
+        interval_ns = self.msg_size * 1000000000 / self.data_rate if self.data_rate > 0 else 0
+        next_start_ns = data_start_ns
+        verbose = self._verbose()
+        while (nbytes > 0 and data_sent < nbytes) or (end_ns is not None and now_ns() < end_ns):
+            rtt_start_ns = now_ns()
             nleft = self.msg_size
             while nleft > 0:
                 nwrite = conn.send(msg[(self.msg_size - nleft):])
@@ -79,29 +85,33 @@ class client_client(clusterbuster_pod_client):
                     nleft -= nread
                 else:
                     raise ClusterBusterPodClientException("Unexpected zero length msg received")
-            en = self._adjusted_time() - rtt_start - time_overhead
+            curtime_ns = now_ns()
+            en = curtime_ns - rtt_start_ns - time_overhead_ns
             ex += en
             ex2 += en * en
             if en > max_latency:
                 max_latency = en
-            if self._verbose():
-                self._timestamp('Write/Read %d %.6f' % (self.msg_size, en))
-            curtime = self._adjusted_time()
-            if self.data_rate > 0:
-                starttime += self.msg_size / self.data_rate
-                if curtime < starttime:
-                    if self._verbose():
-                        self._timestamp('Sleeping %8.6f', starttime - curtime)
-                    time.sleep(starttime - curtime)
+            if verbose:
+                self._debug('Write/Read %d %.6f', self.msg_size, en / 1000000000)
+            if interval_ns:
+                next_start_ns += interval_ns
+                if curtime_ns < next_start_ns:
+                    if verbose:
+                        self._debug('Sleeping %8.6f', (next_start_ns - curtime_ns) / 1000000000)
+                    time.sleep((next_start_ns - curtime_ns) / 1000000000)
                 else:
-                    if self._verbose():
-                        self._timestamp('Not sleeping')
+                    if verbose:
+                        self._debug('Not sleeping')
             npass += 1
-        data_end_time = self._adjusted_time()
+        data_end_ns = now_ns()
+        data_start_time = self._ns_to_adjusted_time(data_start_ns)
+        data_end_time = self._ns_to_adjusted_time(data_end_ns)
+        time_overhead = time_overhead_ns / 1000000000
         if npass > 0:
-            mean_latency = ex / npass
+            mean_latency = ex / npass / 1000000000
             if npass > 1:
-                stdev_latency = math.sqrt((ex2 - (ex * ex / npass)) / (npass - 1))
+                stdev_latency = math.sqrt(max(0, (ex2 - (ex * ex / npass)) / (npass - 1))) / 1000000000
+        max_latency /= 1000000000
 
         user, system = self._cputimes(user, system)
         elapsed_time = data_end_time - data_start_time
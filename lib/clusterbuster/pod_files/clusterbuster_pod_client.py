@@ -24,8 +24,15 @@ import subprocess
 import signal
 import random
 import traceback
-import shutil
-from cb_util import cb_util
+import selectors
+import threading
+from cb_util import cb_util, sync_connection, log_buffer, sampling_profiler, resource_sampler, tree_cleaner
+
+# For the startup timing report.  This is the earliest point at which
+# the time can be recorded without delaying the imports being measured.
+_imports_done_time = time.time()
+_process_start_time = cb_util._process_start_time()
+_bundled = '.pyz' in sys.modules['cb_util'].__file__
 
 
 class ClusterBusterPodClientException(Exception):
@@ -39,6 +46,9 @@ class clusterbuster_pod_client(cb_util):
     """
 
     def __init__(self, initialize_timing_if_needed: bool = True, argv: list = sys.argv, external_sync_only: bool = False):
+        self.__init_start_time = time.time()
+        self.__init_done_time = None
+        self.__worker_start_time = None
         # We need to have the nonce very early to initialize.
         super().__init__(no_timestamp=external_sync_only)
         if external_sync_only:
@@ -55,6 +65,23 @@ class clusterbuster_pod_client(cb_util):
             self.__pod = os.environ.get('__CB_HOSTNAME', socket.gethostname())
             self.__sync_ns_port = None
             self.__sync_watchdog_port = None
+            self.__sync_persistent = False
+            self.__sync_aggregate = False
+            self.__sync_binary_framing = False
+            self.__sync_compress = False
+            self.__sync_time_samples = 0
+            self.__worker_placement = 'none'
+            self.__worker_cpusets = []
+            self.__profile_mode = 'off'
+            self.__profiler = None
+            self.__resource_sample_interval = 0
+            self.__resource_sampler = None
+            self.__cleanup_threads = 8
+            self.__cleanup_stats = None
+            self.__drop_cache_mode = 'global'
+            self.__drop_cache_hypervisor = False
+            self.__aggregator_port = None
+            self.__set_timebase()
         else:
             self.__external_sync_only = False
             print(f'Args: {" ".join(argv)}', file=sys.stderr)
@@ -81,10 +108,37 @@ class clusterbuster_pod_client(cb_util):
                 self.__drop_cache_port = int(argv[14])
             except Exception:
                 self.__drop_cache_port = None
+            self.__sync_persistent = self._toBool(os.environ.get('__CB_SYNC_PERSISTENT', 0), False)
+            self.__sync_aggregate = self._toBool(os.environ.get('__CB_SYNC_AGGREGATE', 0), False)
+            self.__sync_compress = self._toBool(os.environ.get('__CB_SYNC_COMPRESS', 0), False)
+            self.__sync_binary_framing = (self.__sync_compress or
+                                          self._toBool(os.environ.get('__CB_SYNC_BINARY_FRAMING', 0), False))
+            self.__sync_time_samples = int(os.environ.get('__CB_SYNC_TIME_SAMPLES', 0))
+            self._set_connect_policy(initial_backoff=float(os.environ.get('__CB_SYNC_CONNECT_INITIAL_BACKOFF', 0.1)),
+                                     max_backoff=float(os.environ.get('__CB_SYNC_CONNECT_MAX_BACKOFF', 4)),
+                                     connect_timeout=float(os.environ.get('__CB_SYNC_CONNECT_TIMEOUT', 10)),
+                                     max_connecting=int(os.environ.get('__CB_SYNC_MAX_CONNECTING', 0)))
+            self._set_resolver_policy(ttl=float(os.environ.get('__CB_RESOLVER_TTL', 60)),
+                                      shared=self._toBool(os.environ.get('__CB_RESOLVER_SHARED_CACHE', 1), True))
+            self._set_log_policy(level=os.environ.get('__CB_LOG_LEVEL') or ('debug' if self._verbose() else 'info'),
+                                 flush_interval=float(os.environ.get('__CB_LOG_FLUSH_INTERVAL', 1)))
+            self.__worker_placement = os.environ.get('__CB_WORKER_PLACEMENT', 'none') or 'none'
+            self.__worker_cpusets = [cpus for cpus in os.environ.get('__CB_WORKER_CPUSETS', '').split(':') if cpus]
+            if self.__worker_cpusets:
+                self.__worker_placement = 'explicit'
+            self.__profile_mode = os.environ.get('__CB_PROFILE', 'off') or 'off'
+            self.__profile_interval = float(os.environ.get('__CB_PROFILE_INTERVAL', 0.01))
+            self.__profiler = None
+            self.__resource_sample_interval = float(os.environ.get('__CB_RESOURCE_SAMPLE_INTERVAL', 0))
+            self.__resource_sampler = None
+            self.__cleanup_threads = int(os.environ.get('__CB_CLEANUP_THREADS', 8))
+            self.__cleanup_stats = None
+            self.__drop_cache_mode = os.environ.get('__CB_DROP_CACHE_MODE', 'global') or 'global'
+            self.__drop_cache_hypervisor = self._toBool(os.environ.get('__CB_DROP_CACHE_HYPERVISOR', 0), False)
+            self.__aggregator_port = None
             self.__is_worker = False
             self.__start_time = float(time.time())
             self.__enable_sync = True
-            self.__host_table = {}
             self.__reported_results = False
             self.__child_idx = -1
             os.environ['__CB_SYNCHOST'] = self.__synchost
@@ -106,9 +160,12 @@ class clusterbuster_pod_client(cb_util):
                 self._args = argv[15:]
                 self.__timing_parameters = {}
                 self.__timing_initialized = False
+                self.__set_timebase()
                 if initialize_timing_if_needed:
                     self.__initialize_timing()
                 self._set_offset(self.__timing_parameters.get('local_offset_from_sync', 0))
+                self.__init_done_time = time.time()
+                self._timestamp(f'Startup timing: {self.__startup_timing()}')
                 self.__processes = 1
                 self.__requested_ip_addresses = [f'{self.__pod}.{self.__namespace}']
                 self._timestamp(f'Ready to start watchdog client in {self.__pod}.{self.__namespace}')
@@ -141,16 +198,42 @@ class clusterbuster_pod_client(cb_util):
             self.__processes = 1
         pid_count = 0
         pid_hash = dict()
+        # Each worker opens its own sync session
+        self._close_sessions()
+        try:
+            placements = self.__worker_placements(self.__processes)
+        except Exception as err:
+            self.__finish(False, message=f"Cannot place workers: {err}")
+        aggregator_sock = None
+        if self.__sync_aggregate and self.__enable_sync and self.__processes > 1:
+            aggregator_sock = self._listen(port=0, addr='127.0.0.1', backlog=self.__processes)
+            self.__aggregator_port = aggregator_sock.getsockname()[1]
+            self._timestamp(f"Aggregating syncs from {self.__processes} processes on port {self.__aggregator_port}")
         for i in range(self.__processes):
             try:
                 try:
                     child = os.fork()
                 except Exception as err:
-                    self._timestamp(f"Fork failed: {err}")
+                    self._timestamp(f"Fork failed: {err}", level=log_buffer.ERROR)
                     os._exit(1)
                 if child == 0:  # Child
+                    if aggregator_sock:
+                        aggregator_sock.close()
                     self.__is_worker = True
                     self.__child_idx = i
+                    self._reset_connect_statistics()
+                    if placements:
+                        try:
+                            os.sched_setaffinity(0, placements[i])
+                        except Exception as err:
+                            self.__finish(False, message=f"Cannot set CPU affinity to {sorted(placements[i])}: {err}")
+                    if self.__profile_mode in sampling_profiler.timers:
+                        self.__profiler = sampling_profiler(self.__profile_mode, self.__profile_interval)
+                        self.__profiler.start()
+                    if self.__resource_sample_interval > 0:
+                        self.__resource_sampler = resource_sampler(self.__resource_sample_interval, timer=self._adjusted_time)
+                        self.__resource_sampler.start()
+                    self.__worker_start_time = time.time()
                     self._timestamp(f"About to run subprocess {i} (pid {os.getpid()})")
                     try:
                         start_time = self._adjusted_time()
@@ -175,6 +258,8 @@ class clusterbuster_pod_client(cb_util):
                     pid_count = pid_count + 1
             except Exception as err:
                 self.__finish(False, message=f"Subprocess {i} failed: {err}")
+        if aggregator_sock:
+            threading.Thread(target=self.__run_sync_aggregator, args=(aggregator_sock,), daemon=True).start()
         messages = []
         while pid_count > 0:
             try:
@@ -228,31 +313,135 @@ class clusterbuster_pod_client(cb_util):
             time_overhead += end - start
         return time_overhead / 1000
 
+    def _calibrate_time_ns(self):
+        """
+        Estimate the time required to read the monotonic clock
+        :return: Estimated time overhead in integer nanoseconds
+                 for self._monotonic_ns
+        """
+        time_overhead = 0
+        for i in range(1000):
+            start = time.perf_counter_ns()
+            end = time.perf_counter_ns()
+            time_overhead += end - start
+        return time_overhead // 1000
+
+    # Monotonic time in integer nanoseconds, for measuring intervals.
+    # This is the clock itself rather than a wrapper, so that workloads
+    # can bind it locally in hot loops.
+    _monotonic_ns = staticmethod(time.perf_counter_ns)
+
+    def _ns_to_adjusted_time(self, ns: int):
+        """
+        Convert a reading of self._monotonic_ns to the controller-adjusted
+        timebase used by self._adjusted_time
+        :param ns: monotonic time in nanoseconds
+        :return: adjusted time in seconds
+        """
+        return self.__timebase + (ns - self.__timebase_ns) / 1000000000
+
     def _adjusted_time(self, otime: float = 0):
         """
-        Return system time normalized to the host time
+        Return system time normalized to the host time.  This is derived
+        from the monotonic clock, so intervals between two calls are not
+        affected by steps in the system clock.
         :return: System time, normalized to the host time
         """
-        if 'xtime_adjustment' in self.__timing_parameters:
-            return time.time() - self.__timing_parameters['xtime_adjustment'] - otime
-        else:
-            return time.time() - otime
+        return self.__timebase + (time.perf_counter_ns() - self.__timebase_ns) / 1000000000 - otime
+
+    def __set_timebase(self, xtime_adjustment: float = 0):
+        """
+        Map the monotonic clock onto the adjusted timebase, so that
+        absolute times can be computed without reading the system clock.
+        The system clock is read between two readings of the monotonic
+        clock several times, and the tightest bracket is used.
+        :param xtime_adjustment: offset of the adjusted timebase from
+                                 the system clock
+        """
+        best = None
+        for i in range(5):
+            before = time.perf_counter_ns()
+            now = time.time()
+            after = time.perf_counter_ns()
+            if best is None or after - before < best[0]:
+                best = (after - before, (before + after) // 2, now)
+        self.__timebase_ns = best[1]
+        self.__timebase = best[2] - xtime_adjustment
 
-    def _drop_cache(self):
+    def _drop_cache(self, paths: list = None):
         """
         Attempt to drop buffer cache locally and on remote (typically hypervisor)
-        :param service: Service for requesting drop cache
-        :param port: Port for requesting drop cache
+        In targeted mode, if the caller names the files or directories
+        it uses, only the page cache of those files is written back and
+        evicted locally; dentries and inodes are not dropped.  The remote
+        drop, which drops the entire cache of the node it runs on, is
+        then only requested if that node is the hypervisor of a VM
+        rather than the node we share with other pods.
+        :param paths: Files or directory trees used by the workload
         """
-        self._timestamp("Dropping local cache")
-        subprocess.run('sync')
-        if self.__drop_cache_host and self.__drop_cache_port:
+        targeted = paths and self.__drop_cache_mode == 'targeted'
+        if targeted:
+            self.__evict_files(paths)
+        else:
+            self._timestamp("Dropping local cache")
+            subprocess.run('sync')
+        if self.__drop_cache_host and self.__drop_cache_port and (self.__drop_cache_hypervisor or not targeted):
             self._timestamp("Dropping host cache")
             with self._connect_to(self.__drop_cache_host, self.__drop_cache_port) as sock:
                 self._timestamp(f"    Connected to {self.__drop_cache_host}:{self.__drop_cache_port}")
                 sock.recv(1)
                 self._timestamp("    Confirmed")
 
+    def __evict_files(self, paths: list):
+        """
+        Write back and evict from the page cache the files named,
+        and any files below directories named.  Files that can't be
+        opened are skipped.
+        :param paths: Files or directory trees to evict
+        """
+        start = time.time()
+        files = 0
+        errors = 0
+        dirs = []
+        for path in paths:
+            if os.path.isdir(path):
+                dirs.append(path)
+            elif os.path.isfile(path):
+                if self.__evict_file(path):
+                    files += 1
+                else:
+                    errors += 1
+        while dirs:
+            try:
+                with os.scandir(dirs.pop()) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            if self.__evict_file(entry.path):
+                                files += 1
+                            else:
+                                errors += 1
+            except OSError:
+                errors += 1
+        self._timestamp("Evicted %d files (%d errors) in %.3f seconds", files, errors, time.time() - start)
+
+    @staticmethod
+    def __evict_file(path: str):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            # Only clean pages are evicted
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            return True
+        except OSError:
+            return False
+        finally:
+            os.close(fd)
+
     def _podname(self):
         """
         :return: name of our pod
@@ -311,14 +500,24 @@ class clusterbuster_pod_client(cb_util):
             'user_cpu_time': user_cpu,
             'system_cpu_time': sys_cpu,
             'cpu_time': user_cpu + sys_cpu,
-            'timing_parameters': self.__timing_parameters
+            'timing_parameters': dict(self.__timing_parameters, **self._connect_statistics()),
+            'placement': self.__worker_placement_info()
             }
         if isinstance(extra, dict):
             for key, val in extra.items():
                 answer[key] = val
+        if self.__profiler:
+            self.__profiler.stop()
+            answer['profile'] = self.__profiler.summary()
+        if self.__resource_sampler:
+            self.__resource_sampler.stop()
+            answer['resource_samples'] = self.__resource_sampler.summary()
+        if self.__cleanup_stats:
+            answer['cleanup'] = self.__cleanup_stats
+        answer['startup_timing'] = self.__startup_timing()
         self._timestamp(f"Report results: {self._namespace()}, {self._podname()}, {self._container()}, {os.getpid()}")
         try:
-            answer = json.dumps(self._sanitize_json(answer))
+            answer = self._json_dumps(answer)
         except TypeError as exc:
             self.__fail(f"Cannot convert results to JSON: {exc}")
         except Exception as exc:
@@ -340,7 +539,31 @@ class clusterbuster_pod_client(cb_util):
         """
         if self.__enable_sync:
             self._timestamp(f"do_sync_command {token}")
-            self.__do_sync_command('SYNC', token)
+            # Write out anything logged before the barrier rather than
+            # after it, where it would perturb the next measurement
+            self._flush_log()
+            self.__wait_for_scheduled_start(self.__do_sync_command('SYNC', token))
+
+    def __wait_for_scheduled_start(self, answer: bytes):
+        """
+        If the sync service released a barrier with a start time
+        rather than immediately, wait until then.  The start time is
+        in the sync service's timebase.
+        :param answer: reply to the sync request
+        """
+        if not answer or not answer.startswith(b'{'):
+            return
+        try:
+            start_at = json.loads(answer)['start_at']
+        except Exception as err:
+            self._timestamp(f"Could not parse sync reply {answer}: {err}")
+            return
+        delay = start_at + self.__timing_parameters.get('local_offset_from_sync', 0) - time.time()
+        if delay > 0:
+            self._timestamp(f"Waiting {delay:.6f} seconds for scheduled start")
+            time.sleep(delay)
+        else:
+            self._timestamp(f"Scheduled start {-delay:.6f} seconds late")
 
     def _abort(self, msg: str = "Terminating"):
         """
@@ -396,21 +619,7 @@ class clusterbuster_pod_client(cb_util):
         """
         self._timestamp(f"Cleaning up {tree}")
         if doit and os.path.exists(tree):
-            for f in os.listdir(tree):
-                self._timestamp(f"Looking at {f}")
-                if f == '.' or f == '..':
-                    pass
-                f = os.path.join(tree, f)
-                self._timestamp(f"Now looking at {f}")
-                try:
-                    if os.path.isdir(f):
-                        self._timestamp(f"Attempting to clean up subdir {f}")
-                        shutil.rmtree(f, True)
-                    else:
-                        self._timestamp(f"Attempting to clean up file {f}")
-                        os.remove(f)
-                except (FileNotFoundError, PermissionError):
-                    pass
+            self._clean_tree(tree)
         if sync:
             self._sync_to_controller(f"Cleanup {tree}")
         if doit and os.path.exists(tree):
@@ -420,13 +629,35 @@ class clusterbuster_pod_client(cb_util):
                 return False
         return True
 
+    def _clean_tree(self, tree: str, remove_root: bool = False):
+        """
+        Remove the contents of a directory tree in parallel, ignoring
+        errors.  The number of entries removed and the time taken are
+        logged and accumulated into the results.
+        :param tree: Filesystem tree to be cleaned up
+        :param remove_root: Also remove the tree itself
+        :return: dict of entries removed, errors, and seconds taken
+        """
+        stats = tree_cleaner(self.__cleanup_threads).clean(tree, remove_root)
+        self._timestamp("Cleaned up %s: %d entries, %d errors in %.3f seconds",
+                        tree, stats['entries'], stats['errors'], stats['seconds'])
+        if self.__cleanup_stats is None:
+            self.__cleanup_stats = {'entries': 0, 'errors': 0, 'seconds': 0}
+        for key, value in stats.items():
+            self.__cleanup_stats[key] += value
+        return stats
+
     def __wait_forever(self):
         self._timestamp('Waiting forever')
+        self._flush_log()
         signal.pause()
         os.__exit(int(self.__run_failed))
 
     def __fail(self, msg: str):
-        self._timestamp(f"Run failed: {msg}")
+        self._timestamp(f"Run failed: {msg}", level=log_buffer.ERROR)
+        self._flush_log(history=True)
+        # Nothing left to measure, and we may not exit cleanly
+        self._set_log_policy(batch=1)
         msg = f'''{msg}
 Run:
 oc logs -n '{self._namespace()}' '{self._podname()}' -c '{self._container()}'
@@ -434,9 +665,10 @@ oc logs -n '{self._namespace()}' '{self._podname()}' -c '{self._container()}'
         self.__do_sync_command('FAIL', msg, timeout=30)
         self.__run_failed = True
         if self.__is_worker:
+            self._flush_log()
             os._exit(1)
 
-    def _resolve_host(self, addr):
+    def _resolve_host(self, addr, timeout: float = None):
         if not self.__is_raw_ip(addr) and ('sync' not in addr or '@' in addr):
             if '@' not in addr:
                 addr = f'eth0@{addr}'
@@ -447,7 +679,7 @@ oc logs -n '{self._namespace()}' '{self._podname()}' -c '{self._container()}'
             else:
                 raise socket.gaierror("Unable to resolve {addr}")
         else:
-            return super()._resolve_host(addr)
+            return super()._resolve_host(addr, timeout=timeout)
 
     def __is_raw_ip(self, addr):
         return re.search(r'(^|@)?(([0-9]{1,3}\.){3}[0-9]{1,3}$)', addr) is not None
@@ -456,9 +688,10 @@ oc logs -n '{self._namespace()}' '{self._podname()}' -c '{self._container()}'
         answer = {}
         request = {'rqst': []}
         for if_addr in addresses:
-            if if_addr in self.__host_table:
-                self._timestamp(f"Found cached {if_addr} => {self.__host_table[if_addr]}")
-                answer[if_addr] = self.__host_table[if_addr]
+            entry = self._resolver.lookup(if_addr)
+            if entry and entry['addr']:
+                self._timestamp(f"Found cached {if_addr} => {entry['addr']}")
+                answer[if_addr] = entry['addr']
             else:
                 request['rqst'].append(if_addr)
         if len(request['rqst']) > 0 and self.__sync_ns_port > 0:
@@ -466,13 +699,162 @@ oc logs -n '{self._namespace()}' '{self._podname()}' -c '{self._container()}'
             self._timestamp(f"Requested addresses {addresses}, got {ns_answer}")
             for if_addr, addr in ns_answer.items():
                 answer[if_addr] = addr
-                self.__host_table[if_addr] = addr
+                # Pod addresses don't change during a run
+                self._resolver.update(if_addr, addr, ttl=86400)
         return answer
 
+    @staticmethod
+    def __parse_cpulist(cpulist: str):
+        """
+        Parse a kernel-style CPU list (e.g. 0-3,8,10-11)
+        :return: set of CPU numbers
+        """
+        cpus = set()
+        for cpu_range in cpulist.strip().split(','):
+            if not cpu_range:
+                continue
+            low, sep, high = cpu_range.partition('-')
+            cpus.update(range(int(low), int(high or low) + 1))
+        return cpus
+
+    def __numa_nodes(self):
+        """
+        Return the CPUs of each NUMA node that this pod may use
+        :return: dict of node number => sorted list of CPUs.  If the
+                 topology is not available, all CPUs are in node 0.
+        """
+        allowed = os.sched_getaffinity(0)
+        nodes = {}
+        try:
+            for entry in os.scandir('/sys/devices/system/node'):
+                if re.match(r'node[0-9]+$', entry.name):
+                    with open(os.path.join(entry.path, 'cpulist')) as cpulist:
+                        cpus = sorted(self.__parse_cpulist(cpulist.read()) & allowed)
+                    if cpus:
+                        nodes[int(entry.name[4:])] = cpus
+        except OSError:
+            pass
+        if not nodes:
+            nodes = {0: sorted(allowed)}
+        return dict(sorted(nodes.items()))
+
+    def __worker_placements(self, processes: int):
+        """
+        Compute the CPUs each worker should run on according to the
+        placement policy:
+        - compact: CPUs are divided evenly between workers in order,
+          filling one NUMA node before the next
+        - spread: workers are assigned to NUMA nodes in turn, and the
+          CPUs of each node divided evenly between its workers
+        - numa: each worker may use all of the CPUs of one NUMA node,
+          assigned in turn
+        - explicit: workers are given the CPU sets listed, in turn
+        :param processes: number of workers
+        :return: list of CPU sets, one per worker, or None to leave
+                 workers unpinned
+        """
+        policy = self.__worker_placement
+        if policy == 'none':
+            return None
+        nodes = self.__numa_nodes()
+        node_list = list(nodes.values())
+        if policy == 'explicit':
+            allowed = os.sched_getaffinity(0)
+            cpusets = [self.__parse_cpulist(cpus) & allowed for cpus in self.__worker_cpusets]
+            if not all(cpusets):
+                raise ValueError(f"Worker CPU sets {self.__worker_cpusets} include a set with no CPUs available to this pod")
+            return [cpusets[i % len(cpusets)] for i in range(processes)]
+        elif policy == 'compact':
+            node_list = [sum(node_list, [])]
+            workers_by_node = [list(range(processes))]
+        elif policy in ('spread', 'numa'):
+            workers_by_node = [list(range(node, processes, len(node_list))) for node in range(len(node_list))]
+        else:
+            raise ValueError(f"Unknown worker placement policy {policy}")
+        answer = [None] * processes
+        for cpus, workers in zip(node_list, workers_by_node):
+            if not workers:
+                continue
+            if policy == 'numa':
+                for worker in workers:
+                    answer[worker] = set(cpus)
+                continue
+            share = max(1, len(cpus) // len(workers))
+            for idx, worker in enumerate(workers):
+                start = (idx * share) % len(cpus)
+                answer[worker] = set(cpus[start:start + share])
+        return answer
+
+    def __startup_timing(self):
+        """
+        Break down the time from process start to starting the workload:
+        - python_startup: interpreter startup and import of the pod client
+        - workload_import: loading the rest of the workload module
+        - initialization: pod client initialization, including the
+          initial sync with the controller
+        - worker_start: until the worker process started running
+        Phases not yet reached are omitted.
+        """
+        answer = {'bundled': _bundled}
+        if _process_start_time is not None:
+            answer['python_startup'] = max(0, _imports_done_time - _process_start_time)
+        answer['workload_import'] = self.__init_start_time - _imports_done_time
+        if self.__init_done_time is not None:
+            answer['initialization'] = self.__init_done_time - self.__init_start_time
+            if self.__worker_start_time is not None:
+                answer['worker_start'] = self.__worker_start_time - self.__init_done_time
+        return answer
+
+    def __worker_placement_info(self):
+        """
+        Describe where this worker is actually running
+        """
+        cpus = os.sched_getaffinity(0)
+        return {
+            'policy': self.__worker_placement,
+            'cpus': sorted(cpus),
+            'numa_nodes': [node for node, node_cpus in self.__numa_nodes().items() if cpus & set(node_cpus)]
+            }
+
+    def __sample_sync_offset(self, samples: int):
+        """
+        Estimate the offset of the local clock from the sync service's
+        from several time echo requests, NTP-style.  The sample with the
+        smallest round trip time bounds the error most tightly, so that
+        is the one used.
+        :param samples: number of echo requests to send
+        :return: (offset of local clock from sync clock, uncertainty,
+                 round trip time), or None if no sample succeeded
+        """
+        best = None
+        for i in range(samples):
+            try:
+                local_send = time.time()
+                data = self._send_message(self.__synchost, self.__syncport,
+                                          f'{self.__sync_nonce} echo {local_send}', timeout=30,
+                                          persistent=True, binary=self.__sync_binary_framing)
+                local_receive = time.time()
+                reply = json.loads(data.decode('ascii'))
+                remote_receive = reply['request_time']
+                remote_send = reply['reply_time']
+            except Exception as err:
+                self._timestamp(f"Time echo failed: {err}")
+                continue
+            rtt = (local_receive - local_send) - (remote_send - remote_receive)
+            offset = ((local_send - remote_receive) + (local_receive - remote_send)) / 2
+            if best is None or rtt < best[2]:
+                best = (offset, rtt / 2, rtt)
+        if not self.__sync_persistent:
+            self._close_sessions()
+        return best
+
     def __initialize_timing(self):
         if self.__timing_initialized:
             return
         name = self._idname()
+        offset_sample = None
+        if self.__sync_time_samples > 0:
+            offset_sample = self.__sample_sync_offset(self.__sync_time_samples)
         self._timestamp("About to sync")
         request = {'timestamp': '%s', 'name': name, 'have': {}}
         for ifname, addr in self._get_ip_addresses().items():
@@ -487,17 +869,20 @@ oc logs -n '{self._namespace()}' '{self._podname()}' -c '{self._container()}'
             remote_sync = reply['reply_start']
             sync_base_start_time = reply['reply_time']
         except Exception as err:
-            self._timestamp(f"Could not parse response from server: {data}: {err}")
+            self._timestamp(f"Could not parse response from server: {data}: {err}", level=log_buffer.ERROR)
             os._exit(1)
         local_sync_start = self._get_initial_connect_time()
         local_sync = float(time.time())
         local_sync_rtt = local_sync - local_sync_start
         remote_sync_rtt = remote_sync - remote_sync_start
         local_offset_from_sync = (local_sync - remote_sync) - ((local_sync_rtt - remote_sync_rtt) / 2)
+        sync_rtt_delta = local_sync_rtt - remote_sync_rtt
+        sync_offset_uncertainty = sync_rtt_delta / 2
+        if offset_sample:
+            local_offset_from_sync, sync_offset_uncertainty, sync_rtt_delta = offset_sample
         adjusted_start_time = self.__start_time - local_offset_from_sync
         start_offset_from_base = adjusted_start_time - self.__basetime
         local_offset_from_base = local_offset_from_sync + start_offset_from_base
-        sync_rtt_delta = local_sync_rtt - remote_sync_rtt
         xtime_adjustment = self.__basetime + local_offset_from_sync
 
         self.__timing_parameters = {
@@ -518,6 +903,8 @@ oc logs -n '{self._namespace()}' '{self._podname()}' -c '{self._container()}'
             'remote_sync_start': remote_sync_start,
             'start_time': start_offset_from_base,
             'sync_rtt_delta': sync_rtt_delta,
+            'sync_offset_uncertainty': sync_offset_uncertainty,
+            'sync_time_samples': self.__sync_time_samples,
             'xtime_adjustment': xtime_adjustment,
             'remote_sync_base_start_time': sync_base_start_time,
             'local_base_start_time': self.__start_time,
@@ -525,44 +912,137 @@ oc logs -n '{self._namespace()}' '{self._podname()}' -c '{self._container()}'
             'local_offset_from_base': local_offset_from_base,
             }
         self._timestamp("Timing parameters:")
-        json.dump(self.__timing_parameters, sys.stderr)
+        self._timestamp(json.dumps(self.__timing_parameters))
         for key, val in self.__timing_parameters.items():
             self._timestamp('%-32s %f' % (key, val))
             self.__basetime += self.__baseoffset
             self.__crtime += self.__baseoffset
+        self.__set_timebase(xtime_adjustment)
         self.__timing_initialized = True
 
     def __run_watchdog(self):
+        """
+        Send a UDP heartbeat to the sync watchdog every watchdog interval.
+        Heartbeats need no connection setup, so a lost one costs nothing
+        but the datagram; the watchdog only fails a pod after missing
+        several in a row.
+        """
         try:
             child = os.fork()
         except Exception as err:
             print(f'Fork for watchdog failed: {err}', file=sys.stderr)
         if child == 0:
             firsttime = True
+            address = None
+            heartbeat = f'{self.__sync_nonce} hbt {self.__pod}'.encode()
+            sock = socket.socket(type=socket.SOCK_DGRAM)
             while True:
                 try:
                     if not firsttime:
                         time.sleep(self.__sync_watchdog_timeout)
                     firsttime = False
-                    self._timestamp("About to pat the watchdog")
-                    with self._connect_to(self.__synchost, self.__sync_watchdog_port):
-                        pass
-                except Exception:
-                    pass
+                    if address is None:
+                        address = (self._resolve_host(self.__synchost), self.__sync_watchdog_port)
+                        self._timestamp(f"Sending watchdog heartbeats to {address[0]}:{address[1]}")
+                    sock.sendto(heartbeat, address)
+                except Exception as err:
+                    self._timestamp(f"Watchdog heartbeat failed: {err}")
+                    address = None
+
+    def __run_sync_aggregator(self, sock):
+        """
+        Gather the sync requests of this pod's worker processes and
+        forward each barrier to the sync service as a single combined
+        request, then release the workers with its reply.  This cuts
+        the number of clients the sync service must handle per barrier
+        by the number of processes per pod.  Failures are not
+        aggregated; workers report them directly.
+        """
+        sock.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        pending = []
+        while True:
+            for key, mask in selector.select():
+                if key.data is None:
+                    while True:
+                        try:
+                            client, address = sock.accept()
+                        except (BlockingIOError, InterruptedError):
+                            break
+                        client.setblocking(False)
+                        selector.register(client, selectors.EVENT_READ, sync_connection(client, address))
+                    continue
+                conn = key.data
+                try:
+                    token = conn.read_token()
+                except Exception as exc:
+                    self._timestamp(f"Sync aggregator: read from {conn.address} failed: {exc}")
+                    token = b''
+                if token is None:
+                    continue
+                if not token or not conn.session:
+                    selector.unregister(conn.sock)
+                if not token:
+                    conn.sock.close()
+                    continue
+                try:
+                    nonce, command, payload = sync_connection.split_token(token)
+                    nonce = nonce.decode('utf-8')
+                except Exception as exc:
+                    self._timestamp(f"Sync aggregator: unparseable request from {conn.address}: {exc}")
+                    conn.sock.close()
+                    continue
+                if nonce != self.__sync_nonce:
+                    self._timestamp(f"Sync aggregator: request with incorrect nonce {nonce} from {conn.address}")
+                    conn.sock.close()
+                    continue
+                pending.append([conn, command, payload])
+                if len(pending) < self.__processes:
+                    continue
+                command = pending[0][1]
+                if any(p[1] != command for p in pending):
+                    self.__fail(f"Sync aggregator: mismatched commands {[p[1] for p in pending]}")
+                self._timestamp(f"Sync aggregator: forwarding {command} for {len(pending)} processes")
+                # The payloads are forwarded as they were received
+                request = sync_connection.aggregate(command, [p[2] for p in pending])
+                answer = self._send_message(self.__synchost, self.__syncport, request,
+                                            prefix=f'{self.__sync_nonce} aggr ', persistent=self.__sync_persistent,
+                                            binary=self.__sync_binary_framing, compress=self.__sync_compress)
+                for conn, command, payload in pending:
+                    try:
+                        if answer:
+                            conn.reply(answer)
+                        conn.release()
+                    except Exception as exc:
+                        self._timestamp(f"Sync aggregator: unable to release {conn.address}: {exc}")
+                pending = []
+                if command == 'rslt':
+                    selector.close()
+                    sock.close()
+                    return
 
     def __do_sync_command(self, command: str, token: str = '', timeout: float = None, port: int = None):
         if not self.__enable_sync:
             return
+        host = self.__synchost
+        lcommand = command.lower()
         if not port:
             port = self.__syncport
-        lcommand = command.lower()
+            if self.__aggregator_port and self.__is_worker and lcommand != 'fail':
+                host = '127.0.0.1'
+                port = self.__aggregator_port
         if lcommand == 'sync' and (token is None or token == ''):
             token = f'{self._ts()} {self.__pod}-{random.randrange(1000000000)}'
-        token = f'{self.__sync_nonce} {lcommand} {token}'.replace('"%s"', str(time.time()))
+        if lcommand == 'tnet' or lcommand == 'time':
+            # Fill in the send time as late as possible
+            token = token.replace('"%s"', str(time.time()))
         try:
-            return self._send_message(self.__synchost, port, token, timeout=timeout)
+            return self._send_message(host, port, token, timeout=timeout, prefix=f'{self.__sync_nonce} {lcommand} ',
+                                      persistent=self.__sync_persistent and port != self.__sync_ns_port,
+                                      binary=self.__sync_binary_framing, compress=self.__sync_compress)
         except Exception as err:
-            self._timestamp(f"Unable to send sync message: {err}")
+            self._timestamp(f"Unable to send sync message: {err}", level=log_buffer.ERROR)
             os._exit(1)
 
     def __finish(self, status: bool = True, message: str = '', pid: int = os.getpid()):
@@ -574,6 +1054,7 @@ oc logs -n '{self._namespace()}' '{self._podname()}' -c '{self._container()}'
             else:
                 self._timestamp(f"ERROR: Process {pid} failed{message}")
                 self.__fail(f"ERROR: Process {pid} failed{message}")
+            self._flush_log()
             os._exit(int(not status))
         else:
             if status:
@@ -587,6 +1068,7 @@ oc logs -n '{self._namespace()}' '{self._podname()}' -c '{self._container()}'
             else:
                 self.__fail(message)
             if self.__exit_at_end:
+                self._flush_log()
                 os._exit(int(not status))
             else:
                 self.__wait_forever()
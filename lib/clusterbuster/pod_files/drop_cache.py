@@ -1,35 +1,70 @@
 #!/usr/bin/env python3
 
 import os
+import time
+import threading
 from clusterbuster_pod_client import clusterbuster_pod_client
 
 
 class drop_cache_client(clusterbuster_pod_client):
     """
     Drop buffer cache and if needed host cache
+    Requests that arrive within the coalescing window of the first
+    one waiting are all satisfied by a single sync and drop.
     """
     def __init__(self):
         try:
             super().__init__()
             self.listen_port = self._get_drop_cache_port()
+            self.window = float(os.environ.get('__CB_DROP_CACHE_WINDOW', 0.1))
+            self.pending = []
+            self.pending_cv = threading.Condition()
         except Exception as err:
             self._abort(f"Init failed! {err} {' '.join(self._args)}")
 
+    def drop_cache(self):
+        self._timestamp("About to sync()")
+        os.sync()
+        self._timestamp("About to drop cache")
+        try:
+            with open("/proc/sys/vm/drop_caches", 'w') as drop_cache:
+                print('3', file=drop_cache)
+            self._timestamp("Successfully dropped cache")
+        except Exception as exc:
+            self._timestamp(f"Cannot write to /proc/sys/vm/drop_caches: {exc}")
+
+    def drop_cache_loop(self):
+        while True:
+            with self.pending_cv:
+                while not self.pending:
+                    self.pending_cv.wait()
+            # Let concurrent requests accumulate.  Anything arriving after
+            # this point waits for the next drop, so that no requester is
+            # answered by a drop that started before it asked.
+            time.sleep(self.window)
+            with self.pending_cv:
+                batch = self.pending
+                self.pending = []
+            start = time.time()
+            self._timestamp(f"Dropping cache for {len(batch)} requests")
+            self.drop_cache()
+            for conn in batch:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._timestamp(f"Answered {len(batch)} requests in {time.time() - start:.3f} seconds")
+
     def runit(self, process: int):
         sock = self._listen(port=self.listen_port, backlog=128)
+        threading.Thread(target=self.drop_cache_loop, daemon=True).start()
         while True:
             try:
                 conn, address = sock.accept()
-                self._timestamp(f"Accepted connection from {address}, about to sync()")
-                os.sync()
-                self._timestamp("About to drop cache")
-                try:
-                    with open("/proc/sys/vm/drop_caches", 'w') as drop_cache:
-                        print('3', file=drop_cache)
-                    self._timestamp("Successfully dropped cache")
-                except Exception as exc:
-                    self._timestamp(f"Cannot write to /proc/sys/vm/drop_caches: {exc}")
-                conn.close()
+                self._timestamp(f"Accepted connection from {address}")
+                with self.pending_cv:
+                    self.pending.append(conn)
+                    self.pending_cv.notify()
             except Exception:
                 pass
 
@@ -5,6 +5,7 @@ import time
 import subprocess
 import mmap
 import shutil
+import threading
 
 from clusterbuster_pod_client import clusterbuster_pod_client, ClusterBusterPodClientException
 
@@ -17,8 +18,8 @@ class files_client(clusterbuster_pod_client):
     def __init__(self):
         try:
             super().__init__()
-            if len(self._args) > 6:
-                self.dir_list = self._args[6:]
+            if len(self._args) > 7:
+                self.dir_list = self._args[7:]
             else:
                 self.dir_list = ['/var/opt/clusterbuster']
             self.dirs = self._toSize(self._args[0])
@@ -30,6 +31,7 @@ class files_client(clusterbuster_pod_client):
             self.flags = 0
             if self.o_direct:
                 self.flags = os.O_DIRECT
+            self.threads = max(1, int(self._args[6]) if len(self._args) > 6 else 1)
         except Exception as err:
             self._abort(f"Init failed! {err} {' '.join(self._args)}")
 
@@ -42,16 +44,51 @@ class files_client(clusterbuster_pod_client):
             else:
                 raise err
 
+    def run_threads(self, func):
+        """
+        Run func in each of self.threads threads, with the directories
+        of each volume divided between them.  File system calls
+        release the GIL, so the threads perform I/O concurrently.
+        :param func: Function called with the directory indices that
+                     the thread is responsible for
+        :return: list of operations performed by each thread
+        """
+        if self.threads == 1:
+            return [func(range(self.dirs))]
+        thread_ops = [0] * self.threads
+        errors = []
+
+        def run_one(idx: int):
+            try:
+                thread_ops[idx] = func(range(idx, self.dirs, self.threads))
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=run_one, args=(idx,)) for idx in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return thread_ops
+
     def makethem(self, pid: int):
+        ops = 0
+        for bdir in self.dir_list:
+            os.makedirs(f"{bdir}/{self.localid}")
+            ops = ops + 2
+        thread_ops = self.run_threads(self.make_subdirs)
+        return ops + sum(thread_ops), thread_ops
+
+    def make_subdirs(self, subdirs: range):
         buf = mmap.mmap(-1, self.blocksize)
         buf.write(b'a' * self.blocksize)
         ops = 0
         files_created = 0
         for bdir in self.dir_list:
             direc = f"{bdir}/{self.localid}"
-            os.makedirs(direc)
-            ops = ops + 2
-            for subdir in range(self.dirs):
+            for subdir in subdirs:
                 dirname = f"{direc}/{subdir}"
                 os.mkdir(dirname)
                 ops = ops + 1
@@ -78,12 +115,16 @@ class files_client(clusterbuster_pod_client):
         return ops
 
     def readthem(self, pid: int, oktofail: bool = False):
+        ops = 2 * len(self.dir_list)
+        thread_ops = self.run_threads(lambda subdirs: self.read_subdirs(subdirs, oktofail))
+        return ops + sum(thread_ops), thread_ops
+
+    def read_subdirs(self, subdirs: range, oktofail: bool = False):
         dbuf = ''
         ops = 0
         for bdir in self.dir_list:
             direc = f"{bdir}/{self.localid}"
-            ops = ops + 2
-            for subdir in range(self.dirs):
+            for subdir in subdirs:
                 dirname = f"{direc}/{subdir}"
                 ops = ops + 1
                 for fileidx in range(self.files_per_dir):
@@ -110,35 +151,41 @@ class files_client(clusterbuster_pod_client):
         return ops
 
     def removethem(self, pid: int, oktofail: bool = False):
+        ops = 0
+        if oktofail:
+            # Whatever a previous run left behind; no need to stat
+            # each file to find out.
+            for bdir in self.dir_list:
+                ops = ops + self._clean_tree(f"{bdir}/{self.localid}", True)['entries']
+            return ops, []
+        thread_ops = self.run_threads(self.remove_subdirs)
+        for bdir in self.dir_list:
+            self.remdir(f"{bdir}/{self.localid}")
+            ops = ops + 1
+        return ops + sum(thread_ops), thread_ops
+
+    def remove_subdirs(self, subdirs: range):
         ops = 0
         for bdir in self.dir_list:
             direc = f"{bdir}/{self.localid}"
-            if oktofail and not self._isdir(direc):
-                continue
-            for subdir in range(self.dirs):
+            for subdir in subdirs:
                 dirname = f"{direc}/{subdir}"
-                if oktofail and not self._isdir(subdir):
-                    continue
                 for fileidx in range(self.files_per_dir):
                     filename = f"{dirname}/{fileidx}"
-                    if oktofail and not self._isfile(filename):
-                        continue
                     os.unlink(filename)
                     ops = ops + 1
-                self.remdir(dirname, oktofail)
+                self.remdir(dirname)
                 ops = ops + 1
-            self.remdir(direc, oktofail)
-            ops = ops + 1
         return ops
 
     def run_one_operation(self, op_name0: str, op_name1: str, op_name2: str, op_func, pid: int, data_start_time: float):
         self._sync_to_controller(self._idname([pid, f"start {op_name2}"]))
-        self._drop_cache()
+        self._drop_cache([f"{bdir}/{self.localid}" for bdir in self.dir_list])
         ucpu, scpu = self._cputimes()
         op_start_time = self._adjusted_time() - data_start_time
-        ops = op_func(pid)
+        ops, thread_ops = op_func(pid)
         op_end_time_0 = self._adjusted_time() - data_start_time
-        self._drop_cache()
+        self._drop_cache([f"{bdir}/{self.localid}" for bdir in self.dir_list])
         op_end_time = self._adjusted_time() - data_start_time
         op_elapsed_time = op_end_time - op_start_time
         op_elapsed_time_0 = op_end_time_0 - op_start_time
@@ -152,7 +199,9 @@ class files_client(clusterbuster_pod_client):
             'operation_start': op_start_time,
             'operation_end': op_end_time,
             'operations': ops,
-            'operations_per_second': ops / op_elapsed_time
+            'operations_per_second': ops / op_elapsed_time,
+            'threads': self.threads,
+            'thread_operations': thread_ops
             }
         if op_name2 == 'read':
             answer['total_files'] = self.files_per_dir * self.dirs * len(self.dir_list)
@@ -191,6 +240,7 @@ class files_client(clusterbuster_pod_client):
         extras = {
             'summary': {
                 'volumes': len(self.dir_list),
+                'threads': self.threads,
                 'dirs_per_volume': self.dirs,
                 'total_dirs': self.dirs * len(self.dir_list),
                 'self.files_per_dir': self.files_per_dir,
@@ -103,7 +103,7 @@ Drop cache:  {self.fio_drop_cache}""")
                                 for ioengine in self.fio_ioengines:
                                     jobname = '%04d-%s-%d-%d-%d-%d-%d-%s' % (jobidx, pattern, size, iodepth, numjobs, fdatasync, direct, ioengine)
                                     if self.fio_drop_cache:
-                                        self._drop_cache()
+                                        self._drop_cache([os.getcwd()])
                                     self._sync_to_controller(jobname)
                                     if jobidx == 1:
                                         self._timestamp("Running...")
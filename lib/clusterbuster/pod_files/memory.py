@@ -6,7 +6,9 @@ from random import randint, seed, random
 import resource
 import math
 import os
-import numpy.random
+import mmap
+import json
+import threading
 
 from clusterbuster_pod_client import clusterbuster_pod_client, ClusterBusterPodClientException
 
@@ -15,6 +17,14 @@ class memory_client(clusterbuster_pod_client):
     """
     Memory test for clusterbuster
     """
+    allocation_backends = ('bytearray', 'mmap', 'hugetlb')
+    bandwidth_kernels = ('read', 'write', 'copy')
+    # Each thread checks the time after this many bytes
+    bandwidth_chunk = 64 * 1024 * 1024
+    thp_advice = {'hugepage': 'MADV_HUGEPAGE', 'nohugepage': 'MADV_NOHUGEPAGE'}
+    # Not all Python versions define these
+    MAP_POPULATE = getattr(mmap, 'MAP_POPULATE', 0x8000)
+    MAP_HUGETLB = getattr(mmap, 'MAP_HUGETLB', 0x40000)
 
     def __init__(self):
         try:
@@ -38,11 +48,91 @@ class memory_client(clusterbuster_pod_client):
                 raise ClusterBusterPodClientException(f"Start probability must be between 0 and 1 ({self.__start_probability})")
 #            if self.__runtime > 0:
 #                self.__iterations = int(self.__runtime)
+            self.__parse_allocation(self._args[13] if len(self._args) > 13 else '')
+            self.__bandwidth_kernel = (self._args[14] if len(self._args) > 14 else '') or 'read'
+            if self.__bandwidth_kernel not in self.bandwidth_kernels:
+                raise ClusterBusterPodClientException(f"Unknown bandwidth kernel {self.__bandwidth_kernel}")
+            self.__threads = max(1, int(self._args[15]) if len(self._args) > 15 and self._args[15] else 1)
             if not self.__stride or self.__stride <= 0:
                 self.__stride = resource.getpagesize()
+            # numpy is slow to import and only needed for scans,
+            # so import it only then, and before anything is measured.
+            # Without it, sequential scans fall back to a Python loop.
+            self.__numpy = None
+            if self.__scan:
+                try:
+                    import numpy
+                    import numpy.random
+                    self.__numpy = numpy
+                except ImportError:
+                    if self.__scan >= 2:
+                        raise
+                    self._timestamp("numpy not available, using Python scan loop")
         except Exception as err:
             self._abort(f"Init failed! {err} {' '.join(self._args)}")
 
+    def __parse_allocation(self, allocation: str):
+        """
+        Parse an allocation specification of the form
+        backend[,populate][,hugepage|nohugepage]
+        """
+        options = [option for option in allocation.lower().split(',') if option]
+        self.__allocation = allocation or 'bytearray'
+        self.__alloc_backend = 'bytearray'
+        self.__alloc_populate = False
+        self.__alloc_advice = None
+        if options and options[0] in self.allocation_backends:
+            self.__alloc_backend = options.pop(0)
+        for option in options:
+            if option == 'populate':
+                self.__alloc_populate = True
+            elif option in self.thp_advice:
+                self.__alloc_advice = getattr(mmap, self.thp_advice[option])
+            else:
+                raise ClusterBusterPodClientException(f"Unknown memory allocation option {option}")
+        if self.__alloc_backend == 'bytearray' and (self.__alloc_populate or self.__alloc_advice is not None):
+            raise ClusterBusterPodClientException("populate, hugepage, and nohugepage require mmap or hugetlb allocation")
+        self.__hugetlb_pagesize = None
+        if self.__alloc_backend == 'hugetlb':
+            with open('/proc/meminfo') as meminfo:
+                for line in meminfo:
+                    if line.startswith('Hugepagesize:'):
+                        self.__hugetlb_pagesize = int(line.split()[1]) * 1024
+            if not self.__hugetlb_pagesize:
+                raise ClusterBusterPodClientException("hugetlb allocation requested, but huge pages are not supported")
+
+    def allocate(self, size: int):
+        """
+        Allocate a block of memory of at least size bytes with the
+        requested backend.
+        """
+        if self.__alloc_backend == 'bytearray':
+            # It's a lot more efficient space-wise to create a small byte array
+            # and expand it than to create the entire byte array at once.
+            # Creating it all at once temporarily doubles the memory requirement,
+            # while expanding it this way does not consume extra memory.
+            memory_blk = bytearray(b'a')
+            memory_blk *= size
+            return memory_blk
+        flags = mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS
+        if self.__alloc_backend == 'hugetlb':
+            flags |= self.MAP_HUGETLB
+            size = self.__hugetlb_pagesize * int((size + self.__hugetlb_pagesize - 1) / self.__hugetlb_pagesize)
+        # Advice must be given before the pages are faulted in, so
+        # in that case populate the mapping by hand afterwards.
+        if self.__alloc_populate and self.__alloc_advice is None:
+            flags |= self.MAP_POPULATE
+        try:
+            memory_blk = mmap.mmap(-1, size, flags=flags)
+        except OSError as exc:
+            raise ClusterBusterPodClientException(f"Cannot allocate {size} bytes with {self.__allocation}: {exc}") from None
+        if self.__alloc_advice is not None:
+            memory_blk.madvise(self.__alloc_advice)
+            if self.__alloc_populate:
+                pagesize = self.__hugetlb_pagesize or resource.getpagesize()
+                memory_blk[::pagesize] = b'a' * len(range(0, size, pagesize))
+        return memory_blk
+
     def parse_param(self, param: str):
         answer = [int(a) for a in param.split(',', 3)]
         if len(answer) == 1:
@@ -56,14 +146,11 @@ class memory_client(clusterbuster_pod_client):
 
     def runone_op(self, start_time: float, iteration: int, size: int, stride: int, runtime: float, scan: int):
         pages = int(size / stride)
-        # It's a lot more efficient space-wise to create a small byte array
-        # and expand it than to create the entire byte array at once.
-        # Creating it all at once temporarily doubles the memory requirement,
-        # while expanding it this way does not consume extra memory.
+        prealloc_usage = resource.getrusage(resource.RUSAGE_SELF)
         prealloc_time = self._adjusted_time()
-        memory_blk = bytearray(b'a')
-        memory_blk *= size
+        memory_blk = self.allocate(size)
         alloc_time = self._adjusted_time()
+        alloc_usage = resource.getrusage(resource.RUSAGE_SELF)
         if self.__sync_between_iterations:
             self._sync_to_controller(self._idname([f'postalloc-{iteration}', f' {runtime:.3f} ',
                                                    f' {prealloc_time:.3f} ', f' {alloc_time:.3f} ',
@@ -71,64 +158,174 @@ class memory_client(clusterbuster_pod_client):
         run_pages = 0
         loops = 0
         extra_pages = 0
+        bandwidth_stats = {}
         run_start_time = self._adjusted_time()
-        if scan:
-            rng = None
-            # Per https://stackoverflow.com/questions/2709818/fastest-way-to-generate-1-000-000-random-numbers-in-python
-            # this is a much faster way to generate a large number of random numbers (obviously at some
-            # memory cost).  Since we're accessing just one word out of each page, we want
-            # the random number generation to be fast.
-            #
-            # On a Ryzen 3900, it's about 10x faster; random.randint() gets about 1.1E+06 random numbers/sec
-            # while numpy.random with 1000 integers at a time gets about 1.0E+07 random numbers/sec.
-            # Doing more than 1000 yields a small benefit (about 1.1E+07 for 10000 integers),
-            # but at a more significant memory cost.
-            #
-            # Also the time for the rng.integers() call increases as the number of integers per block increases;
-            # for 100 it's about 12 usec, for 1000 it's about 25 usec, and for 10000 it's about 150 usec
-            # (on an unloaded system).  On a heavily loaded system we can expect that to increase some,
-            # possibly enough to affect the loop termination time significantly.
-            pageidx = []
-            curpageidx = 0
-            if scan == 2:
-                numbers_per_block = 1000
-                rng = numpy.random.default_rng()
-                pageidx = rng.integers(pages, high=None, size=numbers_per_block).tolist()
-            done = False
-            end_time = runtime + time.time()
-            while not done:
-                for i in range(pages):
-                    if scan == 2:
-                        if curpageidx >= numbers_per_block:
-                            pageidx = rng.integers(pages, high=None, size=numbers_per_block).tolist()
-                            curpageidx = 0
-                        pp = pageidx[curpageidx]
-                        curpageidx += 1
-                    else:
-                        pp = i
-                    char = 32 + (run_pages % 192)
-                    if runtime >= 0 and i % 1000 == 0 and time.time() >= end_time:
-                        self._timestamp(f"Reached termination at {time.time() - end_time} after {loops} loops and {i} pages")
-                        extra_pages = i
-                        done = True
-                        break
-                    memory_blk[pp * stride] = char
-                    run_pages += 1
-                if not done:
-                    self._timestamp(f"Completed loop {loops} offset {end_time - time.time()} from end")
-                    loops = loops + 1
+        if scan == 3:
+            run_pages, loops, bandwidth_stats = self.scan_bandwidth(memory_blk, size, stride, runtime)
+        elif scan:
+            if self.__numpy:
+                run_pages, loops, extra_pages = self.scan_vectorized(memory_blk, pages, stride, runtime, scan)
+            else:
+                run_pages, loops, extra_pages = self.scan_loop(memory_blk, pages, stride, runtime)
         elif runtime >= 0:
             time.sleep(runtime)
         else:
             signal.pause()
         prefree_time = self._adjusted_time()
+        prefree_usage = resource.getrusage(resource.RUSAGE_SELF)
+        if isinstance(memory_blk, mmap.mmap):
+            memory_blk.close()
         if self.__sync_between_iterations:
             self._sync_to_controller(self._idname([f'prefree-{iteration}', f' {prefree_time:.3f} ',
                                                    f' {prefree_time-alloc_time:.3f} ', self._ts()]))
-        return [run_pages, prealloc_time, alloc_time, run_start_time, prefree_time, loops, extra_pages]
+        case_stats = {
+            'allocation': self.__allocation,
+            'alloc_elapsed_time': alloc_time - prealloc_time,
+            'alloc_bytes_sec': size / (alloc_time - prealloc_time) if alloc_time > prealloc_time else 0,
+            'alloc_minor_faults': alloc_usage.ru_minflt - prealloc_usage.ru_minflt,
+            'alloc_major_faults': alloc_usage.ru_majflt - prealloc_usage.ru_majflt,
+            'scan_minor_faults': prefree_usage.ru_minflt - alloc_usage.ru_minflt,
+            'scan_major_faults': prefree_usage.ru_majflt - alloc_usage.ru_majflt,
+            'scan_bytes_sec': run_pages * stride / (prefree_time - run_start_time) if prefree_time > run_start_time else 0,
+            }
+        case_stats.update(bandwidth_stats)
+        return [run_pages, prealloc_time, alloc_time, run_start_time, prefree_time, loops, extra_pages, case_stats]
+
+    def scan_bandwidth(self, memory_blk: bytearray, size: int, stride: int, runtime: float):
+        """
+        Stream through all of memory_blk with the selected kernel until
+        runtime has elapsed, with the block divided between threads.
+        The kernels are numpy operations that release the GIL, so the
+        threads run in parallel.  read sums the words of the block,
+        write fills them, and copy copies the first half of each
+        thread's part of the block to the second half; bytes read and
+        bytes written are both counted, as in STREAM.
+        :return: equivalent pages scanned, complete passes over the
+                 block, and bandwidth statistics
+        """
+        np = self.__numpy
+        words = np.frombuffer(memory_blk, dtype=np.uint64, count=int(size / 8))
+        kernel = self.__bandwidth_kernel
+        nthreads = min(self.__threads, max(1, len(words)))
+        chunk_words = int(self.bandwidth_chunk / 8)
+        results = [None] * nthreads
+        barrier = threading.Barrier(nthreads)
+        end_time = None
+
+        def stream(idx: int):
+            part = words[int(len(words) * idx / nthreads):int(len(words) * (idx + 1) / nthreads)]
+            if kernel == 'copy':
+                half = int(len(part) / 2)
+                src = part[:half]
+                dst = part[half:half * 2]
+                part = src
+            passes = 0
+            nbytes = 0
+            barrier.wait()
+            start = time.time()
+            now = start
+            while runtime < 0 or now < end_time:
+                for offset in range(0, len(part), chunk_words):
+                    chunk = part[offset:offset + chunk_words]
+                    if kernel == 'read':
+                        chunk.sum()
+                        nbytes += chunk.nbytes
+                    elif kernel == 'write':
+                        chunk.fill(passes)
+                        nbytes += chunk.nbytes
+                    else:
+                        np.copyto(dst[offset:offset + chunk_words], chunk)
+                        nbytes += 2 * chunk.nbytes
+                    now = time.time()
+                    if runtime >= 0 and now >= end_time:
+                        break
+                else:
+                    passes += 1
+            results[idx] = (nbytes, passes, now - start)
+
+        end_time = time.time() + runtime
+        threads = [threading.Thread(target=stream, args=(idx,)) for idx in range(nthreads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        nbytes = sum(result[0] for result in results)
+        elapsed = max(result[2] for result in results)
+        loops = min(result[1] for result in results)
+        self._timestamp("%s bandwidth: %d bytes in %.3f seconds with %d threads, %.3f GB/sec",
+                        kernel, nbytes, elapsed, nthreads, nbytes / elapsed / 1000000000 if elapsed > 0 else 0)
+        return int(nbytes / stride), loops, {
+            'bandwidth_kernel': kernel,
+            'bandwidth_threads': nthreads,
+            'bandwidth_bytes': nbytes,
+            'bandwidth_elapsed_time': elapsed,
+            'bandwidth_bytes_sec': nbytes / elapsed if elapsed > 0 else 0,
+            }
+
+    def scan_vectorized(self, memory_blk: bytearray, pages: int, stride: int, runtime: float, scan: int):
+        """
+        Touch one byte of each stride of memory_blk with numpy, a chunk
+        of pages per operation, until runtime has elapsed.  Sequential
+        scans assign to a slice of a strided view of the block; random
+        scans assign through blocks of random indices generated before
+        each chunk is written.  Chunks start small and grow until each
+        takes about chunk_time, so the interpreter overhead per page is
+        negligible while termination stays prompt.
+        :return: pages touched, complete passes over the block, and
+                 pages touched in the final incomplete pass
+        """
+        np = self.__numpy
+        view = np.frombuffer(memory_blk, dtype=np.uint8)[::stride][:pages]
+        rng = np.random.default_rng() if scan == 2 else None
+        chunk_time = 0.01
+        chunk = min(1024, pages)
+        run_pages = 0
+        loops = 0
+        i = 0
+        end_time = runtime + time.time()
+        while True:
+            count = min(chunk, pages - i)
+            char = 32 + (run_pages % 192)
+            chunk_start = time.time()
+            if rng is not None:
+                view[rng.integers(pages, size=count)] = char
+            else:
+                view[i:i + count] = char
+            now = time.time()
+            run_pages += count
+            i += count
+            if i >= pages:
+                self._debug('Completed loop %d offset %f from end', loops, end_time - now)
+                loops += 1
+                i = 0
+            if runtime >= 0 and now >= end_time:
+                self._timestamp(f"Reached termination at {now - end_time} after {loops} loops and {i} pages")
+                return run_pages, loops, i
+            if now - chunk_start < chunk_time / 2 and chunk < pages:
+                chunk = min(chunk * 2, pages)
+
+    def scan_loop(self, memory_blk: bytearray, pages: int, stride: int, runtime: float):
+        """
+        Touch one byte of each stride of memory_blk in sequence
+        without numpy, until runtime has elapsed.
+        :return: pages touched, complete passes over the block, and
+                 pages touched in the final incomplete pass
+        """
+        run_pages = 0
+        loops = 0
+        end_time = runtime + time.time()
+        while True:
+            for i in range(pages):
+                if runtime >= 0 and i % 1000 == 0 and time.time() >= end_time:
+                    self._timestamp(f"Reached termination at {time.time() - end_time} after {loops} loops and {i} pages")
+                    return run_pages, loops, i
+                memory_blk[i * stride] = 32 + (run_pages % 192)
+                run_pages += 1
+            self._debug('Completed loop %d offset %f from end', loops, end_time - time.time())
+            loops = loops + 1
 
     def runone_child(self, fd, *args):
-        os.write(fd, ' '.join([str(val) for val in self.runone_op(*args)]))
+        os.write(fd, json.dumps(self.runone_op(*args)).encode())
 
     def runone(self, *args):
         # Ensure that we definitely do free the memory we've used by
@@ -143,35 +340,43 @@ class memory_client(clusterbuster_pod_client):
                     self.runone_child(w, start_time, *args)
                 except Exception as exc:
                     self._timestamp(f"Run child failed: {exc}")
+                    self._flush_log()
                     os._exit(1)
+                self._flush_log()
                 os._exit(0)
             else:
                 try:
                     try:
-                        w.close()
+                        os.close(w)
                     except Exception:
                         pass
                     try:
+                        data = b''
+                        while True:
+                            buf = os.read(r, 4096)
+                            if not buf:
+                                break
+                            data += buf
                         (run_pages, prealloc_time, alloc_time, run_start_time,
-                         prefree_time, loops, extra_pages) = [int(x) for x in os.read(r, 4096).decode().split(' ')]
+                         prefree_time, loops, extra_pages, case_stats) = json.loads(data.decode())
                     except Exception as e:
                         self._timestamp(f"Read failed: {e}")
                 finally:
                     try:
-                        r.close()
+                        os.close(r)
                     except Exception:
                         pass
                     try:
-                        cpid, status = os.waitpid(pid)
+                        cpid, status = os.waitpid(pid, 0)
                         if status:
                             raise ClusterBusterPodClientException(f"Child failed, status {int(status / 256)}")
                     except Exception:
                         pass
         else:
             (run_pages, prealloc_time, alloc_time, run_start_time,
-             prefree_time, loops, extra_pages) = self.runone_op(start_time, *args)
+             prefree_time, loops, extra_pages, case_stats) = self.runone_op(start_time, *args)
         return (run_pages, start_time, prealloc_time, alloc_time,
-                run_start_time, prefree_time, loops, extra_pages, self._adjusted_time())
+                run_start_time, prefree_time, loops, extra_pages, case_stats, self._adjusted_time())
 
     def randval(self, i: list):
         if i[1] == i[0]:
@@ -235,21 +440,23 @@ class memory_client(clusterbuster_pod_client):
                     run_time = desired_end_time - curtime
             self._timestamp(f"Running size {run_size} stride {self.__stride} runtime {run_time} scan {self.__scan}")
             (run_pages, start_time, prealloc_time, alloc_time,
-             run_start_time, prefree_time, loops, extra_pages, end_time) = self.runone(iteration,
-                                                                                       run_size, self.__stride,
-                                                                                       run_time, self.__scan)
-            runs.append({'size': run_size,
-                         'runtime': run_time,
-                         'start_time': start_time,
-                         'prealloc_time': prealloc_time,
-                         'alloc_time': alloc_time,
-                         'run_start_time': run_start_time,
-                         'prefree_time': prefree_time,
-                         'end_time': end_time,
-                         'elapsed_time': end_time - start_time,
-                         'pages': run_pages,
-                         'loops': loops,
-                         'extra_pages': extra_pages})
+             run_start_time, prefree_time, loops, extra_pages, case_stats, end_time) = self.runone(iteration,
+                                                                                                   run_size, self.__stride,
+                                                                                                   run_time, self.__scan)
+            case = {'size': run_size,
+                    'runtime': run_time,
+                    'start_time': start_time,
+                    'prealloc_time': prealloc_time,
+                    'alloc_time': alloc_time,
+                    'run_start_time': run_start_time,
+                    'prefree_time': prefree_time,
+                    'end_time': end_time,
+                    'elapsed_time': end_time - start_time,
+                    'pages': run_pages,
+                    'loops': loops,
+                    'extra_pages': extra_pages}
+            case.update(case_stats)
+            runs.append(case)
             pages += run_pages
             job_run_time += (prefree_time - run_start_time)
             elapsed_time += elapsed_time
@@ -264,6 +471,9 @@ class memory_client(clusterbuster_pod_client):
         data_end_time = self._adjusted_time()
         extras = {
             'scan': bool(self.__scan),
+            'scan_engine': ('numpy' if self.__numpy else 'python') if self.__scan else None,
+            'bandwidth_kernel': self.__bandwidth_kernel if self.__scan == 3 else None,
+            'threads': self.__threads if self.__scan == 3 else 1,
             'total_pages': pages,
             'iterations': iteration + 1,
             'runtime': job_run_time,
@@ -15,18 +15,21 @@
 # limitations under the License.
 
 import time
-import re
 import json
 import os
 import sys
 import signal
-from cb_util import cb_util
+import selectors
+import heapq
+from cb_util import cb_util, sync_connection
 
 offset_from_controller = 0
 timebase = cb_util(offset_from_controller)
 nameserver_pid = None
 watchdog_pid = None
+watchdog_expired = False
 sync_nonce = None
+sync_barriers = []
 
 
 def kill_nameserver(timebase: cb_util):
@@ -63,12 +66,20 @@ def touch(file: str):
 
 
 class watchdog:
+    """
+    Watchdog for ClusterBuster workloads.  Clients send periodic
+    heartbeats, normally as UDP datagrams to the watchdog port;
+    TCP connections to the port, and data written to them, are also
+    treated as heartbeats.  Deadlines are kept in a heap, so recording
+    a heartbeat is O(1) and checking for failures only looks at
+    deadlines that have expired.
+    """
     def __init__(self, timebase: cb_util, port: int, backlog: int = 5,
                  timeout: int = 60, caller: int = None, status_file: str = None,
                  caller_signal: int = signal.SIGUSR1):
-        global alarm_status_file, alarm_caller, alarm_signal
         self.timebase = timebase
-        self.addrs = dict()
+        self.deadlines = dict()
+        self.heap = []
         self.caller = caller
         self.caller_signal = caller_signal
         self.timeout = timeout * 4
@@ -77,8 +88,9 @@ class watchdog:
         self.timebase._timestamp("Starting watchdog")
         try:
             self.sock = timebase._listen(port=port, backlog=backlog)
+            self.usock = timebase._get_port(port=port, udp=True)
         except Exception as err:
-            self.fatal(f"listen failed: {err}")
+            fatal(f"listen failed: {err}")
 
     def watchdog_timeout(self, failures):
         if self.status_file:
@@ -97,39 +109,91 @@ class watchdog:
 
     def check_watchdog(self):
         now = time.time()
-        failures = [addr for addr, time in self.addrs.items() if now - time > self.timeout]
+        failures = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, client = heapq.heappop(self.heap)
+            if self.deadlines[client] <= now:
+                failures.append(client)
+            else:
+                heapq.heappush(self.heap, (self.deadlines[client], client))
         if failures:
             self.watchdog_timeout(failures)
 
-    def handle_sigalrm(self, signum, frame):
-        signal.alarm(0)
-        self.check_watchdog()
+    def pat(self, client: str):
+        now = time.time()
+        if client not in self.deadlines:
+            timebase._timestamp(f"Registering watchdog for {client} {int(now)}")
+            heapq.heappush(self.heap, (now + self.timeout, client))
+        self.deadlines[client] = now + self.timeout
+
+    def read_heartbeats(self):
+        while True:
+            try:
+                data, address = self.usock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                nonce, command, client = data.decode('ascii').split(' ', 2)
+            except Exception:
+                timebase._timestamp(f"Malformed heartbeat from {address}")
+                continue
+            if nonce != sync_nonce or command != 'hbt':
+                timebase._timestamp(f"Received heartbeat with incorrect nonce {nonce} from {address}")
+                continue
+            self.pat(client)
 
     def run(self):
-        signal.signal(signal.SIGALRM, self.handle_sigalrm)
+        selector = selectors.DefaultSelector()
+        self.usock.setblocking(False)
+        selector.register(self.usock, selectors.EVENT_READ)
+        selector.register(self.sock, selectors.EVENT_READ)
         while True:
             # Don't start the timer until we have actual clients
-            client, address = self.sock.accept()
-            address = address[0]
-            client.close()
-            if address in self.addrs:
-                timebase._timestamp(f"Resetting watchdog for address {address} {self.addrs[address]} -> {int(time.time())}")
-            else:
-                timebase._timestamp(f"Registering watchdog for address {address} {int(time.time())}")
-            self.addrs[address] = int(time.time())
+            timeout = max(0, self.heap[0][0] - time.time()) if self.heap else None
+            self.timebase._flush_log()
+            for key, mask in selector.select(timeout):
+                if key.fileobj is self.usock:
+                    self.read_heartbeats()
+                elif key.fileobj is self.sock:
+                    client, address = self.sock.accept()
+                    selector.register(client, selectors.EVENT_READ, address[0])
+                    self.pat(address[0])
+                else:
+                    try:
+                        data = key.fileobj.recv(1024)
+                    except Exception:
+                        data = None
+                    if data:
+                        self.pat(key.data)
+                    else:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
             self.check_watchdog()
-            signal.alarm(self.timeout)
 
 
 class nameserver:
     """
-    Simplistic nameserver for ClusterBuster workloads
+    Simplistic nameserver for ClusterBuster workloads.
+    Outstanding requests are indexed by the name they are waiting for,
+    so that an announcement of a name only touches the requests that
+    are waiting for it.
     """
     def __init__(self, timebase: cb_util, port: int, backlog: int = 5):
         self.timebase = timebase
         self.addrs = dict()
+        # Requestor address => {'client', 'have', 'want', 'start'}
         self.requests = dict()
-        self.clients = dict()
+        # Wanted name => set of requestor addresses waiting for it
+        self.waiters = dict()
+        self.stats = {
+            'commands': 0,
+            'lookups': 0,
+            'immediate_lookups': 0,
+            'requests_satisfied': 0,
+            'total_wait_time': 0,
+            'max_wait_time': 0,
+            'max_queue_depth': 0
+            }
         try:
             self.sock = timebase._listen(port=port, backlog=backlog)
         except Exception as err:
@@ -142,46 +206,82 @@ class nameserver:
         self.timestamp(string)
         sys.exit(1)
 
-    def satisfy_requests(self):
-        requestors_satisfied = list()
-        for addr, req in self.requests.items():
-            requests_satisfied = list()
-            for want in req['want'].keys():
-                if want in self.addrs:
-                    self.timestamp(f"    Request from {addr} for {want} => {self.addrs[want]}")
-                    self.requests[addr]['have'][want] = self.addrs[want]
-                    requests_satisfied.append(want)
-            if requests_satisfied:
-                for want in requests_satisfied:
-                    del self.requests[addr]['want'][want]
-                if not self.requests[addr]['want']:
-                    jdata = json.dumps(self.requests[addr]['have'])
-                    self.timestamp(f"        All requests from {addr} are satisfied: {jdata}, sending")
-                    self.clients[addr].send(jdata.encode('ascii'))
-                    self.clients[addr].close()
-                    del self.clients[addr]
-                    requestors_satisfied.append(addr)
-        if requestors_satisfied:
-            for requestor in requestors_satisfied:
-                del self.requests[requestor]
+    def reply(self, addr):
+        """
+        Send the answers to a requestor all of whose names are known
+        """
+        req = self.requests.pop(addr)
+        jdata = json.dumps(req['have'])
+        wait_time = time.time() - req['start']
+        self.stats['requests_satisfied'] += 1
+        self.stats['total_wait_time'] += wait_time
+        self.stats['max_wait_time'] = max(self.stats['max_wait_time'], wait_time)
+        self.timestamp(f"        All requests from {addr} are satisfied: {jdata}, sending")
+        try:
+            req['client'].reply(jdata.encode('ascii'))
+        except Exception as exc:
+            self.timestamp(f"Unable to reply to {addr}: {exc}")
+        req['client'].sock.close()
+
+    def have(self, name: str, ipaddr: str):
+        self.addrs[name] = ipaddr
+        for addr in self.waiters.pop(name, ()):
+            self.timestamp(f"    Request from {addr} for {name} => {ipaddr}")
+            req = self.requests[addr]
+            req['have'][name] = ipaddr
+            req['want'].discard(name)
+            if not req['want']:
+                self.reply(addr)
+
+    def want(self, client, address, names: list):
+        if address not in self.requests:
+            self.requests[address] = {
+                'client': client,
+                'have': {},
+                'want': set(),
+                'start': time.time()
+                }
+        req = self.requests[address]
+        for name in names:
+            self.stats['lookups'] += 1
+            if name in self.addrs:
+                self.stats['immediate_lookups'] += 1
+                req['have'][name] = self.addrs[name]
+            else:
+                req['want'].add(name)
+                self.waiters.setdefault(name, set()).add(address)
+        if not req['want']:
+            self.reply(address)
+        self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], len(self.requests))
+
+    def statistics(self):
+        answer = dict(self.stats)
+        answer['names'] = len(self.addrs)
+        answer['queue_depth'] = len(self.requests)
+        answer['avg_wait_time'] = self.stats['total_wait_time'] / max(1, self.stats['requests_satisfied'])
+        return answer
 
     def get_command(self):
-        client, address = self.sock.accept()
+        self.timebase._flush_log()
+        sock, address = self.sock.accept()
+        client = sync_connection(sock, address)
         try:
-            tbuf = read_token(client)
-            nonce, tbuf = tbuf.split(' ', 1)
+            tbuf = None
+            while tbuf is None:
+                tbuf = client.read_token()
+            nonce, command, payload = sync_connection.split_token(tbuf)
+            nonce = nonce.decode('utf-8')
             if nonce != sync_nonce:
-                self.timestamp(f"Received request with incorrect nonce {nonce} from {address}: {tbuf}")
+                self.timestamp(f"Received request with incorrect nonce {nonce} from {address}: {command}")
                 return None, None, None
-            command = tbuf[0:4].lower()
-            payload = tbuf[4:].lstrip()
+            payload = str(payload, 'utf-8')
             self.timestamp(f"Accepted connection from {address}, command {command}, payload {payload}")
             json_payload = json.loads(payload)
             if command != 'nsrq':
                 raise ValueError(f"Unexpected command {command}")
         except Exception as exc:
-            self.timestamp(f"Could not read command from {client} at {address}: {exc}")
-            client.close()
+            self.timestamp(f"Could not read command from {address}: {exc}")
+            sock.close()
             return
         return client, address, json_payload
 
@@ -193,62 +293,41 @@ class nameserver:
         except Exception as exc:
             self.timestamp(f"Unable to read command: {exc}")
             return
-        for command, args in json_payload.items():
-            if command == 'have':
-                if not isinstance(args, dict):
-                    self.timestamp(f"have payload should be dict, is {args}")
-                    continue
-                for name, ipaddr in args.items():
-                    self.timestamp(f"    {address} offers {name} at {ipaddr}")
-                    self.addrs[name] = ipaddr
-            elif command == 'rqst':
-                if not isinstance(args, list):
-                    self.timestamp(f"rqst payload should be list, is {args}")
-                    continue
-                if address not in self.requests:
-                    self.requests[address] = {
-                        'have': {},
-                        'want': {}
-                        }
-                for name in args:
-                    if address not in self.clients:
-                        self.clients[address] = client
-                    self.requests[address]['want'][name] = None
-            else:
-                self.timestamp(f"Unknown command from {address}: '{command}'")
+        self.stats['commands'] += 1
+        # A request may be a single set of commands or a batch of them
+        if isinstance(json_payload, dict):
+            json_payload = [json_payload]
+        replied = False
+        for commands in json_payload:
+            if not isinstance(commands, dict):
+                self.timestamp(f"Request should be dict, is {commands}")
+                continue
+            for command, args in commands.items():
+                if command == 'have':
+                    if not isinstance(args, dict):
+                        self.timestamp(f"have payload should be dict, is {args}")
+                        continue
+                    for name, ipaddr in args.items():
+                        self.timestamp(f"    {address} offers {name} at {ipaddr}")
+                        self.have(name, ipaddr)
+                elif command == 'rqst':
+                    if not isinstance(args, list):
+                        self.timestamp(f"rqst payload should be list, is {args}")
+                        continue
+                    replied = True
+                    self.want(client, address, args)
+                elif command == 'stat':
+                    replied = True
+                    client.reply(json.dumps(self.statistics()).encode('ascii'))
+                    client.sock.close()
+                else:
+                    self.timestamp(f"Unknown command from {address}: '{command}'")
+        if not replied:
+            client.sock.close()
 
     def run(self):
         while True:
             self.process_command()
-            self.satisfy_requests()
-
-
-def read_token(stream):
-    prefix = stream.recv(10).decode('ascii').lower()
-    if len(prefix) == 0:
-        return None
-    if len(prefix) != 10:
-        raise ValueError("Unable to read token: short read")
-    m = re.match(r'0x[0-9a-z]{8}', prefix)
-    if m:
-        bytes_to_read = int(prefix, base=16)
-    else:
-        raise ValueError(f"Bad token: {prefix}")
-    answer = ''
-    offset = 0
-    while bytes_to_read > 0:
-        try:
-            chunk = stream.recv(bytes_to_read).decode('ascii')
-        except Exception as exc:
-            raise ValueError(f"Bad read with {bytes_to_read} left at offset {offset}: {exc}")
-        nbytes = len(chunk)
-        if nbytes == 0:
-            raise ValueError(f"Short read: got zero bytes with {bytes_to_read} left at {offset}")
-        else:
-            answer += chunk
-            bytes_to_read -= nbytes
-            offset += nbytes
-    return answer
 
 
 def get_controller_timing(timestamp_file: str):
@@ -280,23 +359,80 @@ def get_controller_timing(timestamp_file: str):
     return tsdata
 
 
-def handle_result(tmp_sync_file_base: str, expected_clients: int, tbuf: str):
-    tmp_sync_file = f'{tmp_sync_file_base}-{expected_clients}'
-    try:
-        with open(tmp_sync_file, 'w') as tmp:
-            tmp.write(tbuf.rstrip())
-    except Exception as error:
-        fatal(f"Can't write to sync file {tmp_sync_file}: {error}")
+class result_writer:
+    """
+    Write worker results to the sync file as they arrive, checking
+    each one on its own, so that only one result at a time is held in
+    memory and the final report needs only a short trailer.  The file
+    is a single JSON object; worker_results is written first and the
+    other keys are added when the run finishes.
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.results = 0
+        try:
+            self.file = open(filename, 'w')
+            self.file.write('{\n"worker_results": [\n')
+            # Don't leave anything buffered for forked children to flush
+            self.file.flush()
+        except Exception as exc:
+            fatal(f"Can't write to sync file {filename}: {exc}")
+
+    def add(self, tbuf: str):
+        # Results from our clients are already strict JSON, so once
+        # they're known to parse they can be written as they are.
+        # Anything else (NaN or infinity) has to be re-encoded.
+        nonfinite = []
+        try:
+            result = json.loads(tbuf, parse_constant=nonfinite.append)
+            if nonfinite:
+                timebase._timestamp(f"Warning: illegal float values {nonfinite} in result converted to None")
+                data = timebase._json_dumps(result, sort_keys=True)
+            else:
+                data = tbuf.strip()
+        except Exception as exc:
+            timebase._timestamp(f"Could not load JSON result: {exc}")
+            data = '{}'
+        if self.results:
+            data = ',\n' + data
+        try:
+            self.file.write(data)
+        except Exception as exc:
+            fatal(f"Can't write to sync file {self.filename}: {exc}")
+        self.results += 1
+
+    def finish(self, expected_results: int, trailer: dict):
+        """
+        Complete the file, with an empty result for each client
+        that did not report
+        :param expected_results: number of results expected
+        :param trailer: other keys to add to the file
+        """
+        while self.results < expected_results:
+            self.add('{}')
+        try:
+            self.file.write('\n]')
+            for key, value in sorted(trailer.items()):
+                self.file.write(f',\n{json.dumps(key)}: {timebase._json_dumps(value, sort_keys=True, indent=1)}')
+            self.file.write('\n}\n')
+            self.file.close()
+        except TypeError as exc:
+            fatal(f"Invalid JSON encountered trying to write to sync file {self.filename}: {exc}")
+        except Exception as exc:
+            fatal(f"Can't write to sync file {self.filename}: {exc}")
 
 
 def reply_timestamp(ts_clients: list):
     start = ytime()
     timebase._timestamp("Returning client sync start time, sync start time, sync sent time")
     for client in ts_clients:
-        client_fd, client_ts = client
+        conn, client_ts = client
         client_ts['reply_start'] = start
         client_ts['reply_time'] = ytime()
-        client_fd.send(json.dumps(client_ts).encode('ascii'))
+        try:
+            conn.reply(json.dumps(client_ts).encode('ascii'))
+        except Exception as exc:
+            timebase._timestamp(f"Unable to send sync time to {conn.address}: {exc}")
     end = ytime()
     et = end - start
     timebase._timestamp(f"Sending sync time took {et} seconds")
@@ -317,110 +453,267 @@ def fail_hard(payload: str):
         timebase._timestamp(f"Waiting for error file {error_file} to be removed")
         while timebase._isfile(error_file):
             time.sleep(1)
-    os._exit(1)
+    fatal("Job failed, exiting")
 
 
-def sync_one(sock, tmp_sync_file_base: str, tmp_error_file: str, start_time: float,
-             base_start_time: float, expected_clients: int, first_pass: bool):
-    timebase._timestamp(f"Listening on port {listen_port}, expect {expected_clients} client{'' if expected_clients == 1 else 's'}")
-    try:
-        timebase._listen(sock=sock, backlog=expected_clients)
-    except Exception as err:
-        fatal(f"listen failed: {err}")
-    ts_clients = []
-    net_clients = {}
-    known_addresses = {}
-    # Ensure that the client file descriptors do not get gc'ed,
-    # closing it prematurely.  This is used when we don't
-    # need to send a meaningful reply.  Without this, we do get some
-    # failures.
-    # Tested with
-    # clusterbuster -P synctest --synctest-count=1000 --synctest-cluster-count=3
-    #     --precleanup --deployments=10 --cleanup=0
-    protected_clients = []
-    expected_command = None
-    while expected_clients > 0:
-        # Reverse hostname lookup adds significant overhead
-        # when using sync to establish the timebase.
-        client, address = sock.accept()
-        tbuf = read_token(client)
-        if not tbuf:
-            timebase._timestamp(f"Read token from {address} failed")
-            continue
+class sync_server:
+    """
+    Event driven sync server.  All clients of a barrier are accepted and
+    read concurrently by a single process, rather than one at a time.
+    """
+    def __init__(self, sock, start_time: float, base_start_time: float):
+        self.sock = sock
+        self.start_time = start_time
+        self.base_start_time = base_start_time
+        self.sock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
+    def accept_clients(self):
+        while True:
+            try:
+                client, address = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            client.setblocking(False)
+            self.selector.register(client, selectors.EVENT_READ, sync_connection(client, address))
+
+    def close_client(self, conn: sync_connection):
         try:
-            nonce, tbuf = tbuf.split(' ', 1)
-        except Exception as exc:
-            timebase._timestamp(f"Could not parse token {tbuf}: {exc}")
-            continue
-        # Don't acknowledge replies with incorrect nonce
-        if nonce != sync_nonce:
-            timebase._timestamp(f"Received request with incorrect nonce {nonce} from {address}: {tbuf}")
-            continue
-        protected_clients.append(client)
-        if address in known_addresses:
-            fail_hard(f"Unexpected duplicate request received from {address}: {tbuf}")
-        known_addresses[address] = 1
-        command = tbuf[0:4].lower()
-        payload = tbuf[4:].lstrip()
-        if expected_command:
-            if command != expected_command:
-                fail_hard(f"Unexpected command {command} from {address}, expected {expected_command}, payload {payload}")
-        else:
-            expected_command = command
-        pl = payload if command == 'sync' else len(payload)
-        timebase._timestamp(f"Accepted connection from {address}, command {command}, payload {pl}")
-        if command == 'time' or command == 'tnet':
-            timebase._timestamp(f"Time request {payload}")
-            if first_pass:
-                if command == 'tnet':
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+
+    def release_barrier(self, clients: list, command: str):
+        """
+        Release the clients of a completed barrier.  SYNC barriers are released once after the step
+        interval, optionally split into waves (in order of arrival)
+        spaced release_wave_interval apart.
+
+        If start_lead is set, SYNC barriers are instead released at once
+        with a start time start_lead seconds (plus the step interval and
+        wave offset) in the future, which the clients wait for
+        themselves.  The time it takes to reply to all of the clients
+        then doesn't skew their start.
+        :param clients: Client connections in order of arrival
+        :param command: Command of the barrier
+        :return: list of waves with their scheduled and actual release times
+        """
+        waves = release_waves if command == 'sync' else 1
+        waves = max(1, min(waves, len(clients)))
+        scheduled_start = command == 'sync' and start_lead > 0
+        release_start = ytime()
+        if command == 'sync' and step_interval > 0:
+            release_start += step_interval
+        if scheduled_start:
+            release_start += start_lead
+        answer = []
+        for wave in range(waves):
+            wave_clients = clients[int(wave * len(clients) / waves):int((wave + 1) * len(clients) / waves)]
+            scheduled = release_start
+            if command == 'sync':
+                scheduled += wave * release_wave_interval
+            delay = scheduled - ytime()
+            if scheduled_start:
+                start_message = json.dumps({'start_at': scheduled}).encode('ascii')
+            elif delay > 0:
+                timebase._timestamp(f"Waiting {delay:.3f} seconds to release wave {wave} ({len(wave_clients)} clients)")
+                time.sleep(delay)
+            actual_start = ytime()
+            for client in wave_clients:
+                try:
+                    if scheduled_start:
+                        client.reply(start_message)
+                    client.release()
+                except Exception as exc:
+                    timebase._timestamp(f"Unable to release {client.address}: {exc}")
+                    self.close_client(client)
+            answer.append({
+                'clients': len(wave_clients),
+                'scheduled_release': scheduled,
+                'release_start': actual_start,
+                'release_end': ytime(),
+                'scheduled_start': scheduled_start
+                })
+        return answer
+
+    def sync_one(self, results: result_writer, expected_clients: int, first_pass: bool):
+        timebase._timestamp(f"Listening on port {listen_port}, "
+                            f"expect {expected_clients} client{'' if expected_clients == 1 else 's'}")
+        try:
+            timebase._listen(sock=self.sock, backlog=expected_clients)
+        except Exception as err:
+            fatal(f"listen failed: {err}")
+        ts_clients = []
+        net_clients = {}
+        known_addresses = {}
+        # Clients that have checked in are held until the barrier
+        # completes; closing a one-shot connection, or replying on a
+        # session, is what releases them.
+        # Tested with
+        # clusterbuster -P synctest --synctest-count=1000 --synctest-cluster-count=3
+        #     --precleanup --deployments=10 --cleanup=0
+        protected_clients = []
+        expected_command = None
+        command = None
+        first_arrival = None
+        last_arrival = None
+        while expected_clients > 0:
+            if watchdog_expired:
+                return 1
+            # Log output is written while waiting for clients rather than
+            # while releasing them
+            timebase._flush_log()
+            # Wake up periodically to notice a watchdog timeout
+            for key, mask in self.selector.select(1 if watchdog_pid else None):
+                if key.data is None:
+                    self.accept_clients()
+                    continue
+                conn = key.data
+                address = conn.address
+                try:
+                    tbuf = conn.read_token()
+                except Exception as exc:
+                    timebase._timestamp(f"Read token from {address} failed: {exc}")
+                    self.close_client(conn)
+                    continue
+                if tbuf is None:
+                    continue
+                received = ytime()
+                if not tbuf:
+                    if conn.session:
+                        timebase._timestamp(f"Session from {address} closed")
+                    else:
+                        timebase._timestamp(f"Read token from {address} failed")
+                    self.close_client(conn)
+                    continue
+                if not conn.session:
+                    self.selector.unregister(conn.sock)
+                # The token is split in place; only the nonce, the
+                # command, and then the payload are decoded
+                try:
+                    nonce, command, payload = sync_connection.split_token(tbuf)
+                    nonce = nonce.decode('utf-8')
+                except Exception as exc:
+                    timebase._timestamp(f"Could not parse token {bytes(tbuf[:128])}: {exc}")
+                    self.close_client(conn)
+                    continue
+                # Don't acknowledge replies with incorrect nonce
+                if nonce != sync_nonce:
+                    timebase._timestamp(f"Received request with incorrect nonce {nonce} from {address}: {command}")
+                    self.close_client(conn)
+                    continue
+                # Time echo requests are answered at once rather than
+                # held for the barrier, so their round trip time is only
+                # the network's and can be used to estimate clock offset.
+                if command == 'echo':
                     try:
-                        jdata = json.loads(payload)
-                        ts = jdata['timestamp']
-                        if 'have' in jdata and isinstance(jdata['have'], dict):
-                            for name, addr in jdata['have'].items():
-                                if name.startswith('eth0@'):
-                                    timebase._timestamp(f"Using {address[0]} for {name}")
-                                    net_clients[name] = address[0]
-                                else:
-                                    net_clients[name] = addr
+                        conn.reply(json.dumps({'client_ts': str(payload, 'utf-8').strip(),
+                                               'request_time': received,
+                                               'reply_time': ytime()}).encode('ascii'))
                     except Exception as exc:
-                        timebase._timestamp(f"Failed to parse JSON data: {exc}")
+                        timebase._timestamp(f"Unable to send time echo to {address}: {exc}")
+                        self.close_client(conn)
                         continue
+                    if not conn.session:
+                        conn.sock.close()
+                    continue
+                protected_clients.append(conn)
+                last_arrival = ytime()
+                if first_arrival is None:
+                    first_arrival = last_arrival
+                if address in known_addresses:
+                    fail_hard(f"Unexpected duplicate request received from {address}: {command}")
+                known_addresses[address] = 1
+                payloads = [payload]
+                if command == 'aggr':
+                    # Requests from several clients combined by a sync aggregator
+                    try:
+                        command, payloads = sync_connection.split_aggregate(payload)
+                    except Exception as exc:
+                        fail_hard(f"Could not parse aggregated request from {address}: {exc}")
+                payloads = [str(payload, 'utf-8') for payload in payloads]
+                payload = payloads[0]
+                if expected_command:
+                    if command != expected_command:
+                        fail_hard(f"Unexpected command {command} from {address}, "
+                                  f"expected {expected_command}, payload {payload}")
                 else:
-                    ignore, ts, ignore = payload.split()
-                ts_clients.append([client,
-                                   {
-                                    "client_ts": ts,
-                                    "request_time": ytime(),
-                                    "start_time": start_time,
-                                    "base_start_time": base_start_time
-                                    }])
-            else:
-                fail_hard(f"Unexpected request for time sync from {payload}")
-        elif command == 'rslt':
-            handle_result(tmp_sync_file_base, expected_clients, payload)
-        elif command == 'fail':
-            timebase._timestamp(f"Detected failure from {address}")
-            fail_hard(payload)
-        elif command == 'sync':
-            if step_interval > 0:
-                timebase._timestamp(f"Waiting for {step_interval} seconds...")
-                time.sleep(step_interval)
-                timebase._timestamp("Done waiting")
+                    expected_command = command
+                pl = payload if command == 'sync' else len(payload)
+                if len(payloads) > 1:
+                    pl = f'{pl} (+{len(payloads) - 1} aggregated)'
+                timebase._timestamp(f"Accepted connection from {address}, command {command}, payload {pl}")
+                if command == 'time' or command == 'tnet':
+                    timebase._timestamp(f"Time request {payload}")
+                    if len(payloads) > 1:
+                        fail_hard(f"Unexpected aggregated request for time sync from {address}")
+                    if first_pass:
+                        if command == 'tnet':
+                            try:
+                                jdata = json.loads(payload)
+                                ts = jdata['timestamp']
+                                if 'have' in jdata and isinstance(jdata['have'], dict):
+                                    for name, addr in jdata['have'].items():
+                                        if name.startswith('eth0@'):
+                                            timebase._timestamp(f"Using {address[0]} for {name}")
+                                            net_clients[name] = address[0]
+                                        else:
+                                            net_clients[name] = addr
+                            except Exception as exc:
+                                timebase._timestamp(f"Failed to parse JSON data: {exc}")
+                                continue
+                        else:
+                            ignore, ts, ignore = payload.split()
+                        ts_clients.append([conn,
+                                           {
+                                            "client_ts": ts,
+                                            "request_time": ytime(),
+                                            "start_time": self.start_time,
+                                            "base_start_time": self.base_start_time
+                                            }])
+                    else:
+                        fail_hard(f"Unexpected request for time sync from {payload}")
+                elif command == 'rslt':
+                    for result in payloads:
+                        results.add(result)
+                elif command == 'fail':
+                    timebase._timestamp(f"Detected failure from {address}")
+                    fail_hard(payload)
+                elif command == 'sync':
+                    pass
+                else:
+                    timebase._timestamp(f"Unknown command from {address}: '{command}'")
+                expected_clients -= len(payloads)
+                if expected_clients <= 0:
+                    break
+        if ts_clients:
+            reply_timestamp(ts_clients)
+        if net_clients:
+            msg = json.dumps({'have': net_clients})
+            timebase._send_message('127.0.0.1', ns_port, f"{sync_nonce} nsrq {msg}")
+        sync_barriers.append({
+            'command': command,
+            'clients': len(protected_clients),
+            'first_arrival': first_arrival,
+            'last_arrival': last_arrival,
+            'waves': self.release_barrier(protected_clients, command)
+            })
+        timebase._timestamp("Sync complete")
+        if command == 'rslt':
+            return 2
         else:
-            timebase._timestamp(f"Unknown command from {address}: '{command}'")
-        expected_clients -= 1
-    if ts_clients:
-        reply_timestamp(ts_clients)
-    if net_clients:
-        msg = json.dumps({'have': net_clients})
-        command = f'nsrq {msg}'
-        timebase._send_message('127.0.0.1', ns_port, f"{sync_nonce} {command}")
-    timebase._timestamp("Sync complete")
-    if command == 'rslt':
-        return 2
-    else:
-        return 0
+            return 0
+
+
+def get_nameserver_statistics():
+    try:
+        answer = timebase._send_message('127.0.0.1', ns_port, f"{sync_nonce} nsrq {json.dumps({'stat': None})}", timeout=10)
+        return json.loads(answer)
+    except Exception as exc:
+        timebase._timestamp(f"Unable to retrieve nameserver statistics: {exc}")
+        return {}
 
 
 def finish():
@@ -431,38 +724,23 @@ def finish():
     if timebase._isfile(tmp_error_file):
         fatal("Job failed, exiting")
 
-    result = {
-        'controller_timing': controller_timestamp_data
-        }
-
-    data = []
-
-    if tmp_sync_files:
-        for f in tmp_sync_files:
-            try:
-                with open(f, "r") as fp:
-                    content = fp.read()
-                    datum = json.loads(content)
-                    data.append(datum)
-            except Exception as exc:
-                timebase._timestamp(f"Could not load JSON from {f}: {exc}")
-                data.append(dict())
-    else:
-        data = [dict() for i in expected_clients]
-    result['worker_results'] = data
-
-    try:
-        with open(tmp_sync_file_base, 'w') as tmp:
-            tmp.write(json.dumps(timebase._sanitize_json(result), sort_keys=True, indent=1))
-    except TypeError as exc:
-        fatal(f"Invalid JSON encountered trying to write to sync file {tmp_sync_file_base}: {exc}")
-    except Exception as exc:
-        fatal(f"Can't write to sync file {tmp_sync_file_base}: {exc}")
+    results.finish(expected_clients, {
+        'controller_timing': controller_timestamp_data,
+        'sync_release': {
+            'step_interval': step_interval,
+            'waves': release_waves,
+            'wave_interval': release_wave_interval,
+            'start_lead': start_lead,
+            'barriers': sync_barriers
+            },
+        'nameserver_statistics': get_nameserver_statistics()
+        })
     try:
         os.rename(tmp_sync_file_base, sync_file)
     except Exception as exc:
         fatal(f"Can't rename {tmp_sync_file_base} to {sync_file}: {exc}")
     timebase._timestamp(f"Waiting for sync file {sync_file} to be removed")
+    timebase._flush_log()
     while timebase._isfile(sync_file):
         time.sleep(1)
     timebase._timestamp(f"Sync file {sync_file} removed, exiting")
@@ -487,6 +765,9 @@ try:
     initial_expected_clients = int(sys.argv[13])
     if initial_expected_clients < 0:
         initial_expected_clients = expected_clients
+    release_waves = int(sys.argv[14]) if len(sys.argv) > 14 else 1
+    release_wave_interval = float(sys.argv[15]) if len(sys.argv) > 15 else 0
+    start_lead = float(sys.argv[16]) if len(sys.argv) > 16 else 0
 except Exception as exc:
     timebase._timestamp(f"Can't initialize arguments: {exc}")
 
@@ -502,7 +783,7 @@ if error_file:
     tmp_error_file = f'{error_file}-tmp'
 else:
     tmp_error_file = None
-tmp_sync_files = [f"{tmp_sync_file_base}-{i}" for i in range(1, expected_clients + 1)]
+results = result_writer(tmp_sync_file_base)
 
 controller_timestamp_data = get_controller_timing(controller_timestamp_file)
 offset_from_controller = controller_timestamp_data['offset_from_controller']
@@ -527,8 +808,10 @@ else:
 
 
 def watchdog_handler(signum, frame):
-    timebase._timestamp("Watchdog timeout")
-    finish()
+    # Only note the timeout; the main loop finishes up, as doing so
+    # here could interrupt it in the middle of writing a result.
+    global watchdog_expired
+    watchdog_expired = True
 
 
 # Set up watchdog
@@ -540,7 +823,7 @@ if watchdog_port:
         fatal(f"Fork failed: {exc}")
     if child == 0:
         timebase._timestamp("About to launch watchdog")
-        watchdog(timebase, watchdog_port, caller=pid).run()
+        watchdog(timebase, watchdog_port, timeout=watchdog_timeout, caller=pid).run()
         sys.exit()
     else:
         signal.signal(signal.SIGUSR1, watchdog_handler)
@@ -548,43 +831,28 @@ if watchdog_port:
 
 
 timebase._timestamp("Starting sync")
+server = sync_server(sock, start_time, base_start_time)
 first_pass = True
 while True:
     if timebase._isfile(tmp_error_file):
         fatal("Job failed, exiting")
-    tmp_sync_file = None
-    # Ensure that all of the accepted connections get closed by exiting
-    # a child process.  This way we don't have to keep track of all of the
-    # clients and close them manually.
-    try:
-        child = os.fork()
-    except Exception as exc:
-        fatal(f"Fork failed: {exc}")
-    status = -1
-    if child == 0:
-        if first_pass:
-            clients = initial_expected_clients
-        else:
-            clients = expected_clients
-        sys.exit(sync_one(sock, tmp_sync_file_base, tmp_error_file, start_time, base_start_time, clients, first_pass))
+    if first_pass:
+        clients = initial_expected_clients
     else:
-        try:
-            pid, status = os.wait()
-        except Exception as err:
-            fatal(f"Wait failed: {err}")
+        clients = expected_clients
+    status = server.sync_one(results, clients, first_pass)
+    if watchdog_expired:
+        timebase._timestamp("Watchdog timeout")
+        break
     if first_pass:
         touch("/tmp/clusterbuster-started")
         if predelay > 0:
             timebase._timestamp(f"Waiting {predelay} seconds before start")
             time.sleep(predelay)
         first_pass = False
-    if (status >> 8) == 2:
+    if status == 2:
         timebase._timestamp("Final sync complete, finishing up")
         touch("/tmp/clusterbuster-finished")
         break
-    elif status & 255:
-        fatal(f"Sync killed by signal {status & 255}")
-    elif status != 0:
-        fatal("Job failed, exiting")
 
 finish()
@@ -150,7 +150,7 @@ class sysbench_client(clusterbuster_pod_client):
                 self._timestamp(f'Preparing {" ".join(args)}')
                 subprocess.run(args, check=True)
 
-                self._drop_cache()
+                self._drop_cache([localrundir])
                 self._sync_to_controller(f'{test}+{mode}+run')
                 op_user, op_sys = self._cputimes()
                 args = self.build_sysbench_cmd('run', f'--file-test-mode={test}', f'--file-io-mode={mode}')
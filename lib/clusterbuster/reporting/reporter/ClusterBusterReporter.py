@@ -305,9 +305,13 @@ class ClusterBusterReporter:
         self._header_keys = {}
         self._fields_to_copy = []
         self._expect_row_data = True
+        self._profile_top_frames = 10
         self._add_explicit_timeline_vars(['data_start_time', 'data_end_time', 'pod_start_time', 'pod_create_time'])
         self._add_accumulators(['user_cpu_time', 'system_cpu_time', 'cpu_time', 'data_elapsed_time',
-                                'timing_parameters.sync_rtt_delta'])
+                                'timing_parameters.sync_rtt_delta', 'timing_parameters.sync_offset_uncertainty',
+                                'timing_parameters.connect_retries', 'timing_parameters.connect_max_time',
+                                'startup_timing.python_startup', 'startup_timing.workload_import',
+                                'startup_timing.initialization', 'cleanup.entries', 'cleanup.seconds'])
         if 'metrics' in self._jdata:
             self.metrics = PrometheusMetrics(self._jdata['metrics'], self._abs_start, self._abs_end)
         else:
@@ -374,6 +378,10 @@ class ClusterBusterReporter:
         """
         results['Total Clients'] = self._summary['total_instances']
         results['Total Pods'] = self._summary['total_pods']
+        if 'workers_by_numa_node' in self._summary:
+            results['Workers by NUMA node'] = {f'{node}:{numa_node}': count
+                                               for (node, numa_node), count
+                                               in sorted(self._summary['workers_by_numa_node'].items())}
         if 'elapsed_time_average' in self._summary:
             results['Elapsed time average'] = self._prettyprint(self._summary['elapsed_time_average'],
                                                                 precision=3, suffix='sec')
@@ -429,6 +437,13 @@ class ClusterBusterReporter:
                                                               precision=3, suffix='sec')
             results['Sync avg RTT delta'] = self._prettyprint(self._summary['timing_parameters']['avg_sync_rtt_delta'],
                                                               precision=3, suffix='sec')
+            if 'max_sync_offset_uncertainty' in self._summary['timing_parameters']:
+                uncertainty = self._summary['timing_parameters']['max_sync_offset_uncertainty']
+                results['Sync max offset uncertainty'] = self._prettyprint(uncertainty, precision=3, suffix='sec')
+            if 'connect_retries' in self._summary['timing_parameters']:
+                results['Sync connect retries'] = self._summary['timing_parameters']['connect_retries']
+                results['Sync max connect time'] = \
+                    self._prettyprint(self._summary['timing_parameters']['max_connect_max_time'], precision=3, suffix='sec')
             results['First run end'] = self._prettyprint(self._summary['first_data_end_time'],
                                                          precision=3, suffix='sec')
             results['Last run end'] = self._prettyprint(self._summary['last_data_end_time'],
@@ -440,6 +455,26 @@ class ClusterBusterReporter:
                                                                  precision=3, suffix='sec')
             offset_error = timing['second_controller_ts'] - timing['first_controller_ts']
             results['Max sync offset error'] = self._prettyprint(offset_error, precision=3, suffix='sec')
+        if 'peak_cgroup_memory' in self._summary:
+            results['Peak cgroup memory'] = self.__format_memory_value(self._summary['peak_cgroup_memory'])
+        if 'max_cpu_throttled_time' in self._summary:
+            results['Max CPU throttled time'] = self._prettyprint(self._summary['max_cpu_throttled_time'],
+                                                                  precision=3, suffix='sec')
+        if 'max_python_startup' in self._summary.get('startup_timing', {}):
+            startup = self._summary['startup_timing']
+            results['Max Python startup time'] = self._prettyprint(startup['max_python_startup'], precision=3, suffix='sec')
+            results['Avg Python startup time'] = self._prettyprint(startup['avg_python_startup'], precision=3, suffix='sec')
+            results['Max workload import time'] = self._prettyprint(startup['max_workload_import'], precision=3, suffix='sec')
+            results['Max initialization time'] = self._prettyprint(startup['max_initialization'], precision=3, suffix='sec')
+        if 'max_seconds' in self._summary.get('cleanup', {}):
+            results['Cleanup entries removed'] = self._summary['cleanup']['entries']
+            results['Max cleanup time'] = self._prettyprint(self._summary['cleanup']['max_seconds'], precision=3, suffix='sec')
+        if self._summary.get('profile_samples'):
+            frames = sorted(self._summary['profile_frames'].items(), key=lambda item: item[1], reverse=True)
+            results['Profile samples'] = self._summary['profile_samples']
+            results['Profile top frames'] = {frame: self._prettyprint(count / self._summary['profile_samples'],
+                                                                      precision=3, base=100, suffix='%')
+                                             for frame, count in frames[:self._profile_top_frames]}
 
     def _generate_row(self, results, row: dict):
         """
@@ -474,6 +509,18 @@ class ClusterBusterReporter:
             rowhash['container'] = row['container']
             rowhash['node'] = self.__find_node_for_pod(namespace=row['namespace'], pod=row['pod'])
             rowhash['process_id'] = row['process_id']
+            if 'placement' in row:
+                rowhash['placement'] = row['placement']
+                if row['placement']['policy'] != 'none':
+                    # NUMA node numbers are only meaningful within a node
+                    by_node = self._summary.setdefault('workers_by_numa_node', {})
+                    for numa_node in row['placement']['numa_nodes']:
+                        key = (str(rowhash['node']), numa_node)
+                        by_node[key] = by_node.get(key, 0) + 1
+            if 'profile' in row:
+                self.__add_profile(row['profile'])
+            if 'resource_samples' in row:
+                self.__add_resource_samples(row['resource_samples'])
             for var in self._timeline_vars:
                 self.__update_timeline_val(var, row, self._summary)
             for field_to_copy in self._fields_to_copy:
@@ -484,6 +531,32 @@ class ClusterBusterReporter:
         self._rows.append(rowhash)
         return len(self._rows)-1
 
+    def __add_profile(self, profile: dict):
+        """
+        Accumulate the samples of a worker's profile by innermost frame
+        :param profile: profile reported by a worker
+        """
+        frames = self._summary.setdefault('profile_frames', {})
+        self._summary['profile_samples'] = self._summary.get('profile_samples', 0) + profile.get('samples', 0)
+        for stack, count in profile.get('stacks', {}).items():
+            frame = stack.rsplit(';', 1)[-1]
+            frames[frame] = frames.get(frame, 0) + count
+
+    def __add_resource_samples(self, samples: dict):
+        """
+        Track the peak cgroup memory usage and the most CPU throttling
+        seen by any worker while it ran
+        :param samples: resource samples reported by a worker
+        """
+        values = samples.get('values', {})
+        memory = [val for val in values.get('memory_current', []) if val is not None]
+        if memory:
+            self._summary['peak_cgroup_memory'] = max(self._summary.get('peak_cgroup_memory', 0), max(memory))
+        throttled = [val for val in values.get('cpu_throttled_usec', []) if val is not None]
+        if throttled:
+            self._summary['max_cpu_throttled_time'] = max(self._summary.get('max_cpu_throttled_time', 0),
+                                                          (throttled[-1] - throttled[0]) / 1000000)
+
     def _get_metric_value(self, metric_name: str, time: float, selector: dict = None):
         try:
             return self.metrics.get_value_by_key(metric_name, time, selector)
@@ -41,6 +41,8 @@ class files_reporter(ClusterBusterReporter):
             dest[cop]['Operations/sec'] = self._safe_div(sop['operations'], sop['operation_elapsed_time'], 0)
             sop['operations_cpu_sec'] = self._safe_div(sop['operations'], sop['cpu_time'])
             dest[cop]['Operations/CPU sec'] = self._safe_div(sop['operations'], sop['cpu_time'], 0)
+            if sop.get('thread_operations'):
+                dest[cop]['Operations by Thread'] = sop['thread_operations']
             if op == 'read':
                 dest[cop]['Total Files'] = sop['total_files']
                 dest[cop]['Total Data'] = self._prettyprint(sop['data_size'], base=1024, suffix="B", precision=3)
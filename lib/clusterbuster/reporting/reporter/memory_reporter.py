@@ -92,16 +92,24 @@ class memory_reporter(ClusterBusterReporter):
         self.net_end_time = None
         self.timeline = None
         self.scan = "None"
+        workload_options = jdata.get('metadata', {}).get('options', {}).get('workload_options', {})
+        self.allocation = workload_options.get('memory_allocation')
+        self.bandwidth_kernel = workload_options.get('memory_bandwidth_kernel')
         try:
             scantype = jdata['metadata']['options']['workload_options']['memory_scan']
             if scantype == 1:
                 self.scan = 'Sequential'
             elif scantype == 2:
                 self.scan = 'Random'
+            elif scantype == 3:
+                self.scan = 'Bandwidth'
         except KeyError:
             pass
         self._add_explicit_timeline_vars(['cases.alloc_time', 'cases.prefree_time', 'cases.runtime', 'cases.run_start_time'])
-        self._add_accumulators(['total_pages', 'cases.runtime', 'cases.prefree_time', 'cases.run_start_time'])
+        self._add_accumulators(['total_pages', 'cases.runtime', 'cases.prefree_time', 'cases.run_start_time',
+                                'cases.size', 'cases.alloc_elapsed_time', 'cases.alloc_minor_faults',
+                                'cases.alloc_major_faults', 'cases.scan_minor_faults', 'cases.scan_major_faults',
+                                'cases.bandwidth_bytes_sec'])
         for obj in jdata.get('api_objects', []):
             try:
                 name = f'{obj["metadata"]["name"]}.{obj["metadata"]["namespace"]}'
@@ -269,6 +277,21 @@ class memory_reporter(ClusterBusterReporter):
                         current_idx += 1
         return events
 
+    def __node_bandwidth(self):
+        """
+        Memory bandwidth by node, as the sum over the processes on
+        each node of their average bandwidth over their iterations.
+        Processes run concurrently, so this is the bandwidth that
+        the node sustained.
+        """
+        bandwidth = {}
+        for result in self._jdata['Results']['worker_results']:
+            rates = [case['bandwidth_bytes_sec'] for case in result.get('cases', []) if 'bandwidth_bytes_sec' in case]
+            if rates:
+                node = self.pod_node.get(f'{result["pod"]}.{result["namespace"]}', 'unknown')
+                bandwidth[node] = bandwidth.get(node, 0) + sum(rates) / len(rates)
+        return bandwidth
+
     def build_timeline(self):
         if self.timeline is None:
             try:
@@ -353,6 +376,26 @@ class memory_reporter(ClusterBusterReporter):
                                                                 self._summary['job_runtime'])
         results['Scan Pattern'] = self.scan
         self._summary['scan_pattern'] = self.scan
+        if 'max_alloc_elapsed_time' in self._summary:
+            if self.allocation:
+                results['Allocation'] = self.allocation
+            results['Max Allocation Time'] = self._prettyprint(self._summary['max_alloc_elapsed_time'],
+                                                               precision=3, suffix='sec')
+            results['Allocation Rate'] = self._prettyprint(self._safe_div(self._summary['size'],
+                                                                          self._summary['alloc_elapsed_time']),
+                                                           precision=3, base=1000, suffix='B/sec')
+            results['Allocation Faults (minor/major)'] = \
+                f"{self._summary['alloc_minor_faults']}/{self._summary['alloc_major_faults']}"
+            results['Scan Faults (minor/major)'] = \
+                f"{self._summary['scan_minor_faults']}/{self._summary['scan_major_faults']}"
+        if 'max_bandwidth_bytes_sec' in self._summary:
+            node_bandwidth = self.__node_bandwidth()
+            self._summary['node_bandwidth'] = node_bandwidth
+            results['Bandwidth Kernel'] = self.bandwidth_kernel
+            results['Max Process Bandwidth'] = self._prettyprint(self._summary['max_bandwidth_bytes_sec'],
+                                                                 precision=3, base=1000, suffix='B/sec')
+            results['Node Bandwidth'] = {node: self._prettyprint(node_bandwidth[node], precision=3, base=1000, suffix='B/sec')
+                                         for node in sorted(node_bandwidth.keys())}
         if self.args.timeline_file:
             if self.timeline:
                 timeline_report = self.format_timeline(timeline_format=self.args.timeline_format)